@@ -0,0 +1,202 @@
+# =============================================================================#
+# Name        : actor_learner.py                                               #
+# Description : Parallel actor processes feeding a central DQN learner         #
+# ---------------------------------------------------------------------------- #
+
+import multiprocessing as mp
+import queue
+import time
+
+import numpy as np
+
+from tetris_game import cols, rows, reward_weights, observation_input_shapes
+
+# Configuration
+num_actors = max(mp.cpu_count() - 1, 1)
+batch_size = 32
+total_env_steps = 1000000
+chunk_size = 64            # Transitions sent by an actor at a time
+sync_every = 50            # Learner updates between weight syncs to the actors
+target_sync_every = 1000   # Learner updates between target network alignments
+time_steps_per_episode = 20000
+save_model_as = 'actor_learner_q_network.h5'
+
+
+# Exploration rates spread over the actors like in Ape-X, from base down to base ** (1 + alpha)
+def actor_epsilons(n, base=0.4, alpha=7):
+    if n == 1:
+        return [base]
+    return [base ** (1 + i / (n - 1) * alpha) for i in range(n)]
+
+
+def epsilon_at(epsilon, step):
+    # An epsilon is either a constant or a picklable schedule taking the actor's step count
+    if callable(epsilon):
+        return epsilon(step)
+    return epsilon
+
+
+def put_until_stopped(target_queue, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            target_queue.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+# ================================================================================================#
+#                                           Actor                                                #
+# ================================================================================================#
+
+def run_actor(actor_id, epsilon, transition_queue, weight_queue, stop_event, seed, options):
+    # Imported here so each spawned actor only loads what it needs
+    from dqn_agent import DQNAgent
+    from tetris_game import TetrisApp
+
+    np.random.seed(seed)
+    environment = TetrisApp(headless=True, seed=seed, obs_mode=options['obs_mode'], cols=options['cols'],
+                            rows=options['rows'], reward_weights=options['reward_weights'])
+    # Actors only act, so they skip importing Keras
+    agent = DQNAgent(memory_size=1, backend='numpy')
+
+    # Build the network and wait for the learner's weights before acting
+    agent.q_network.predict_on_batch(np.zeros(environment.observe().shape, dtype=np.float32))
+    agent.set_weights(weight_queue.get())
+
+    chunk = []
+    steps = 0
+    while not stop_event.is_set():
+        environment.start_game(False)
+        state = environment.observe().copy()
+        episodes_reward = 0
+
+        for time_step in range(time_steps_per_episode):
+            # Pick up the newest weights if the learner has published some
+            try:
+                agent.set_weights(weight_queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            agent.epsilon = epsilon_at(epsilon, steps)
+            environment.reset_reward()
+            action = agent.act(state)
+            next_state, reward, terminated, bumpiness, total_height, total_holes = environment.play(action)
+            # The chunk outlives the observation buffers of the environment
+            next_state = next_state.copy()
+            chunk.append((state, action, reward, next_state, terminated, bumpiness, total_height, total_holes))
+            state = next_state
+            episodes_reward += reward
+            steps += 1
+
+            if len(chunk) == chunk_size:
+                # Send the chunk as columns, ready for ReplayBuffer.store_batch
+                put_until_stopped(transition_queue, ('transitions', [np.array(column) for column in zip(*chunk)]),
+                                  stop_event)
+                chunk = []
+
+            if terminated or stop_event.is_set():
+                break
+
+        put_until_stopped(transition_queue, ('episode', actor_id, episodes_reward,
+                                             environment.get_number_of_lines()), stop_event)
+
+
+# ================================================================================================#
+#                                          Learner                                               #
+# ================================================================================================#
+
+def publish_weights(weight_queues, weights):
+    # Every actor keeps only the newest weights, stale ones are replaced
+    for weight_queue in weight_queues:
+        try:
+            weight_queue.get_nowait()
+        except queue.Empty:
+            pass
+        weight_queue.put(weights)
+
+
+def run_actor_learner(agent, actors=num_actors, epsilons=None, env_steps=total_env_steps, obs_mode='position',
+                      cols=cols, rows=rows, reward_weights=reward_weights):
+    """Trains agent on transitions from a pool of actor processes, returns the number of learner updates.
+    The actors play on cols x rows boards with the rewards weighted by reward_weights and observe obs_mode"""
+    if epsilons is None:
+        epsilons = actor_epsilons(actors)
+
+    # Spawned actors start from a clean interpreter instead of a fork of the learner's Keras state
+    context = mp.get_context('spawn')
+    transition_queue = context.Queue(maxsize=actors * 16)
+    weight_queues = [context.Queue(maxsize=1) for _ in range(actors)]
+    stop_event = context.Event()
+
+    options = {'obs_mode': obs_mode, 'cols': cols, 'rows': rows, 'reward_weights': tuple(reward_weights)}
+    input_shape = observation_input_shapes(cols, rows)[obs_mode]
+    agent.q_network.predict_on_batch(np.zeros(input_shape, dtype=np.float32))
+    agent.target_network.predict_on_batch(np.zeros(input_shape, dtype=np.float32))
+    agent.align_target_model()
+    publish_weights(weight_queues, agent.q_network.get_weights())
+
+    processes = [context.Process(target=run_actor,
+                                 args=(i, epsilons[i], transition_queue, weight_queues[i], stop_event, i, options),
+                                 daemon=True)
+                 for i in range(actors)]
+    for process in processes:
+        process.start()
+
+    steps = 0
+    updates = 0
+    episodes = 0
+    failed = set()
+    start_timer = time.time()
+    while steps < env_steps:
+        # Store everything the actors have sent, wait for data while the buffer is too small
+        while True:
+            try:
+                message = transition_queue.get(timeout=1.0 if len(agent.experience_replay) <= batch_size else 0)
+            except queue.Empty:
+                break
+            if message[0] == 'transitions':
+                agent.store_batch(*message[1])
+                steps += len(message[1][1])
+            else:
+                episodes += 1
+                print("Actor: ", message[1], "Episode reward: ", message[2], "Cleared lines: ", message[3])
+
+        # An actor that crashed never sends anything again, the learner stops once none are left
+        for i, process in enumerate(processes):
+            if i not in failed and process.exitcode:
+                failed.add(i)
+                print("Actor: ", i, "exited with code: ", process.exitcode)
+        if not any(process.is_alive() for process in processes):
+            stop_event.set()
+            raise RuntimeError("All actors exited after %d env steps, exit codes: %s" %
+                               (steps, [process.exitcode for process in processes]))
+
+        if len(agent.experience_replay) > batch_size:
+            agent.retrain(batch_size)
+            updates += 1
+            if updates % sync_every == 0:
+                publish_weights(weight_queues, agent.q_network.get_weights())
+            if updates % target_sync_every == 0:
+                agent.align_target_model()
+
+    stop_event.set()
+    for process in processes:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+
+    total_time = time.time() - start_timer
+    print("______________________________________")
+    print("Env steps: ", steps, "Learner updates: ", updates, "Episodes: ", episodes)
+    print("Env steps per second: ", steps / total_time)
+    print("______________________________________")
+    return updates
+
+
+if __name__ == '__main__':
+    from dqn_agent import DQNAgent
+
+    learner = DQNAgent(memory_size=100000)
+    run_actor_learner(learner)
+    learner.save_model(save_model_as)
@@ -0,0 +1,192 @@
+# =============================================================================#
+# Name        : benchmark.py                                                   #
+# Description : Headless throughput benchmarks for the engine and the agent    #
+# ---------------------------------------------------------------------------- #
+# Every result is appended as one JSON line to the output file, together with  #
+# the git commit, so regressions show up when comparing runs across commits.   #
+# =============================================================================#
+
+import argparse
+import json
+import platform
+import random
+import subprocess
+import time
+
+import numpy as np
+
+import tetris_game
+from tetris_game import (TetrisApp, check_collision, join_matrixes, remove_row, rotate_clockwise, create_board,
+                         tetris_shapes, rows, cols)
+from vec_tetris import VecTetris
+from search_agent import SearchAgent
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def time_calls(function, min_time):
+    """Calls function until min_time seconds have passed and returns the mean seconds per call"""
+    calls = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time:
+        function()
+        calls += 1
+        elapsed = time.perf_counter() - start
+    return elapsed / calls
+
+
+# A half filled board with a few holes, seeded so every run times the same position
+def sample_board(seed):
+    rng = random.Random(seed)
+    board = create_board()
+    for y in range(rows // 2, rows):
+        for x in range(cols):
+            if rng.random() < 0.7:
+                board[y][x] = 1 + rng.randrange(len(tetris_shapes))
+    return board
+
+
+def run_env(environment, steps, seed):
+    rng = random.Random(seed)
+    for _ in range(steps):
+        if environment.play(rng.randrange(5))[2]:
+            environment.start_game(False)
+
+
+# ================================================================================================#
+#                                        Benchmarks                                              #
+# ================================================================================================#
+
+def bench_env(min_time, seed):
+    results = []
+    for engine in ('list', 'bitboard'):
+        environment = TetrisApp(headless=True, engine=engine, seed=seed)
+        seconds = time_calls(lambda: run_env(environment, 1000, seed), min_time)
+        results.append(('env.play.%s' % engine, 1000 / seconds, 'steps/s'))
+
+    environment = TetrisApp(headless=True, engine='bitboard', seed=seed)
+    placements = lambda: environment.get_placements()
+    results.append(('env.get_placements', time_calls(placements, min_time) * 1e6, 'us/call'))
+
+    # Pieces placed per second by the two-ply search
+    environment = TetrisApp(headless=True, engine='bitboard', seed=seed)
+    search_agent = SearchAgent()
+
+    def play_search():
+        for _ in range(100):
+            if search_agent.play(environment)[2]:
+                environment.start_game(False)
+    results.append(('search.play.depth2', 100 / time_calls(play_search, min_time), 'pieces/s'))
+
+    vec = VecTetris(1024, seed=seed)
+    actions = np.random.default_rng(seed).integers(5, size=(16, 1024))
+    seconds = time_calls(lambda: [vec.step(a) for a in actions], min_time)
+    results.append(('vec.step.1024', 16 * 1024 / seconds, 'steps/s'))
+    return results
+
+
+def bench_functions(min_time, seed):
+    board = sample_board(seed)
+    shape = tetris_shapes[0]
+    offset = (cols // 2 - 1, rows // 2 - 2)
+    bitboard = tetris_game.bitboard_from_board(board)
+    masks = tetris_game.shape_masks[tetris_game.shape_key(shape)]
+
+    calls = {
+        'check_collision': lambda: check_collision(board, shape, offset),
+        'check_collision_bits': lambda: tetris_game.check_collision_bits(bitboard, masks, offset),
+        'join_matrixes': lambda: join_matrixes([row[:] for row in board], shape, offset),
+        'remove_row': lambda: remove_row([row[:] for row in board], rows - 1),
+        'rotate_clockwise': lambda: rotate_clockwise(shape),
+        'copy_board': lambda: [row[:] for row in board],
+        'bitboard_features': lambda: tetris_game.bitboard_features(bitboard)
+    }
+    return [('fn.%s' % name, time_calls(call, min_time) * 1e6, 'us/call') for name, call in calls.items()]
+
+
+def bench_features(min_time, seed):
+    environment = TetrisApp(headless=True, seed=seed)
+    environment.board = sample_board(seed)
+    environment.rescan_columns()
+
+    calls = {
+        'total_height': environment.total_height,
+        'bumpiness': environment.bumpiness,
+        'number_of_holes': environment.number_of_holes,
+        'get_reward': environment.get_reward,
+        'rescan_columns': environment.rescan_columns,
+        'observe': environment.observe
+    }
+    return [('features.%s' % name, time_calls(call, min_time) * 1e6, 'us/call') for name, call in calls.items()]
+
+
+def bench_agent(min_time, seed, batch_sizes, backend):
+    # Imported here so the engine benchmarks run without Keras
+    from dqn_agent import DQNAgent
+
+    np.random.seed(seed)
+    random.seed(seed)
+    agent = DQNAgent(memory_size=10000, backend=backend)
+    agent.epsilon = 0.0
+
+    environment = TetrisApp(headless=True, seed=seed)
+    state = environment.observe()
+    for _ in range(max(batch_sizes) * 4):
+        action = random.randrange(5)
+        next_state, reward, terminated, bumpiness, total_height, total_holes = environment.play(action)
+        agent.store(state, action, reward, next_state, terminated, bumpiness, total_height, total_holes)
+        state = next_state
+        if terminated:
+            environment.start_game(False)
+            state = environment.observe()
+
+    # The first calls build the networks and trace each batch size, they are not timed
+    agent.act(state)
+    results = [('agent.act', time_calls(lambda: agent.act(state), min_time) * 1e3, 'ms/call')]
+    states = agent.experience_replay.states[:1024]
+    results.append(('agent.act_batch.1024', time_calls(lambda: agent.act_batch(states), min_time) * 1e3,
+                    'ms/call'))
+    for batch_size in batch_sizes:
+        agent.retrain(batch_size)
+        seconds = time_calls(lambda: agent.retrain(batch_size), min_time)
+        results.append(('agent.retrain.%d' % batch_size, seconds * 1e3, 'ms/batch'))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless throughput benchmarks')
+    parser.add_argument('--output', default='benchmark_results.jsonl', help='JSON lines file to append to')
+    parser.add_argument('--min-time', type=float, default=1.0, help='Seconds to time each benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[32, 64, 128, 256])
+    parser.add_argument('--skip-agent', action='store_true', help='Only benchmark the engine')
+    parser.add_argument('--backend', default='keras', choices=['keras', 'numpy'], help='Network backend of the agent')
+    args = parser.parse_args()
+
+    results = bench_env(args.min_time, args.seed)
+    results += bench_functions(args.min_time, args.seed)
+    results += bench_features(args.min_time, args.seed)
+    if not args.skip_agent:
+        results += bench_agent(args.min_time, args.seed, args.batch_sizes, args.backend)
+
+    run = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'seed': args.seed,
+        'backend': args.backend
+    }
+    with open(args.output, 'a') as f:
+        for name, value, unit in results:
+            f.write(json.dumps(dict(run, name=name, value=value, unit=unit)) + '\n')
+            print("%-32s %14.3f %s" % (name, value, unit))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+# =============================================================================#
+# Name        : checkpoint.py                                                  #
+# Description : Asynchronous checkpoints of the full training state            #
+# ---------------------------------------------------------------------------- #
+# A checkpoint is a directory holding both networks as .npz weight files, the  #
+# optimizer state, every replay column as a .npy file that is memory-mapped    #
+# when loaded, and a pickle with epsilon, the counters and the random states.  #
+# The state is copied on the training thread, except the replay columns that  #
+# the background writer copies a chunk at a time, so training stalls no longer #
+# as the buffer grows. The writer fills a temporary directory that is renamed  #
+# when complete, so a crash never leaves a half written checkpoint behind.     #
+# =============================================================================#
+
+import glob
+import os
+import pickle
+import random
+import shutil
+import threading
+
+import numpy as np
+
+import numpy_network
+
+latest_file = 'latest'
+
+# Replay slots copied per hold of the replay lock while writing a checkpoint
+replay_chunk = 16384
+
+
+# ================================================================================================#
+#                                          Snapshots                                             #
+# ================================================================================================#
+
+def network_activations(network):
+    if isinstance(network, numpy_network.NumpyNetwork):
+        return network.activations
+    return [layer.activation.__name__ for layer in network.layers]
+
+
+def optimizer_state(network):
+    if isinstance(network, numpy_network.NumpyNetwork):
+        return network.get_optimizer_state()
+    if not network.optimizer.built:
+        return []
+    return [np.array(variable) for variable in network.optimizer.variables]
+
+
+def set_optimizer_state(network, state):
+    if isinstance(network, numpy_network.NumpyNetwork):
+        network.set_optimizer_state(state)
+    elif state:
+        if not network.optimizer.built:
+            network.optimizer.build(network.trainable_variables)
+        for variable, value in zip(network.optimizer.variables, state):
+            variable.assign(value)
+
+
+def take_snapshot(agent, trainer=None, environment=None, extra=None):
+    """Copies everything needed to resume training. With a trainer its locks are held while copying,
+    so a learner thread can not change the networks or the replay halfway, and the replay columns are
+    left for write_snapshot to copy in chunks under the replay lock. extra holds the caller's own
+    values, for example the episode number"""
+    replay = agent.experience_replay
+    if trainer is not None:
+        trainer.train_lock.acquire()
+        trainer.replay_lock.acquire()
+    try:
+        q_weights = agent.q_network.get_weights()
+        if q_weights:
+            # The target network is built lazily, its first weights have to be in the checkpoint too
+            agent.build_network(agent.target_network, q_weights[0].shape[0])
+        replay_arrays, replay_values = replay.snapshot()
+        replay_copy = None
+        if trainer is None:
+            replay_arrays.update(replay.copy_columns())
+        else:
+            replay_copy = (replay, trainer.replay_lock, replay.begin_copy())
+        snapshot = {
+            'q_network': q_weights,
+            'target_network': agent.target_network.get_weights(),
+            'activations': network_activations(agent.q_network),
+            'optimizer': optimizer_state(agent.q_network),
+            'replay_arrays': replay_arrays,
+            'replay_copy': replay_copy,
+            'state': {
+                'epsilon': agent.epsilon,
+                'replay': replay_values,
+                'numpy_random': np.random.get_state(),
+                'random': random.getstate(),
+                'extra': extra or {}
+            }
+        }
+    finally:
+        if trainer is not None:
+            trainer.replay_lock.release()
+            trainer.train_lock.release()
+
+    if trainer is not None:
+        snapshot['state']['trainer'] = {'env_steps': trainer.env_steps, 'updates': trainer.updates}
+    if environment is not None:
+        # The next episode seed comes from this generator, so resuming continues with the same games
+        snapshot['state']['seed_generator'] = environment.seed_generator.getstate()
+    return snapshot
+
+
+def write_snapshot(path, snapshot):
+    """Writes a snapshot as the checkpoint directory path"""
+    temporary = path + '.tmp'
+    try:
+        if os.path.exists(temporary):
+            shutil.rmtree(temporary)
+        os.makedirs(temporary)
+        if snapshot.get('replay_copy') is not None:
+            copy_replay_columns(temporary, *snapshot['replay_copy'])
+    finally:
+        # A failed write drops the replay copy, the buffer stops keeping overwritten rows for it
+        if snapshot.get('replay_copy') is not None:
+            replay, lock = snapshot['replay_copy'][:2]
+            with lock:
+                replay.end_copy()
+
+    if snapshot['q_network']:
+        numpy_network.save_weights(os.path.join(temporary, 'q_network.npz'), snapshot['q_network'],
+                                   snapshot['activations'])
+        numpy_network.save_weights(os.path.join(temporary, 'target_network.npz'), snapshot['target_network'],
+                                   snapshot['activations'])
+    np.savez(os.path.join(temporary, 'optimizer.npz'), *snapshot['optimizer'])
+    for name, column in snapshot['replay_arrays'].items():
+        np.save(os.path.join(temporary, 'replay_%s.npy' % name), column)
+    with open(os.path.join(temporary, 'state.pkl'), 'wb') as f:
+        pickle.dump(snapshot['state'], f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    os.replace(temporary, path)
+
+
+def copy_replay_columns(directory, replay, lock, layout):
+    """Copies the replay columns of a copy started with begin_copy into .npy files in directory, holding
+    lock for one chunk at a time so the training thread keeps storing in between"""
+    if not layout:
+        return
+    out = {name: np.lib.format.open_memmap(os.path.join(directory, 'replay_%s.npy' % name), mode='w+',
+                                           dtype=dtype, shape=shape)
+           for name, (dtype, shape) in layout.items()}
+    for start in range(0, replay.capacity, replay_chunk):
+        with lock:
+            replay.copy_chunk(out, start, min(start + replay_chunk, replay.capacity))
+    with lock:
+        replay.end_copy(out)
+    for column in out.values():
+        column.flush()
+
+
+def read_snapshot(path):
+    """Reads a checkpoint directory, the replay columns are memory-mapped"""
+    with open(os.path.join(path, 'state.pkl'), 'rb') as f:
+        state = pickle.load(f)
+
+    snapshot = {'state': state, 'q_network': [], 'target_network': []}
+    if os.path.exists(os.path.join(path, 'q_network.npz')):
+        snapshot['q_network'] = numpy_network.load_weights(os.path.join(path, 'q_network.npz'))[0]
+        snapshot['target_network'] = numpy_network.load_weights(os.path.join(path, 'target_network.npz'))[0]
+    with np.load(os.path.join(path, 'optimizer.npz')) as saved:
+        snapshot['optimizer'] = [saved['arr_%d' % i] for i in range(len(saved.files))]
+    snapshot['replay_arrays'] = {
+        os.path.basename(column_path)[len('replay_'):-len('.npy')]: np.load(column_path, mmap_mode='r')
+        for column_path in glob.glob(os.path.join(path, 'replay_*.npy'))}
+    return snapshot
+
+
+def restore_snapshot(snapshot, agent, trainer=None, environment=None):
+    """Puts a snapshot back into the agent, trainer and environment, returns the extra values"""
+    state = snapshot['state']
+    if snapshot['q_network']:
+        input_dim = snapshot['q_network'][0].shape[0]
+        agent.build_network(agent.q_network, input_dim)
+        agent.build_network(agent.target_network, input_dim)
+        agent.set_weights(snapshot['q_network'])
+        agent.target_network.set_weights(snapshot['target_network'])
+    set_optimizer_state(agent.q_network, snapshot['optimizer'])
+    agent.experience_replay.restore(snapshot['replay_arrays'], state['replay'])
+    agent.epsilon = state['epsilon']
+    np.random.set_state(state['numpy_random'])
+    random.setstate(state['random'])
+
+    if trainer is not None and 'trainer' in state:
+        trainer.env_steps = state['trainer']['env_steps']
+        trainer.updates = state['trainer']['updates']
+    if environment is not None and 'seed_generator' in state:
+        environment.seed_generator.setstate(state['seed_generator'])
+    return state['extra']
+
+
+# ================================================================================================#
+#                                     Background Writer                                          #
+# ================================================================================================#
+
+class CheckpointWriter(object):
+    """Writes checkpoints named checkpoint_<step> into directory from a background thread and keeps
+    the newest keep of them. The file `latest` names the newest complete checkpoint"""
+
+    def __init__(self, directory, keep=3):
+        self.directory = directory
+        self.keep = keep
+        self.thread = None
+        self.error = None
+        os.makedirs(directory, exist_ok=True)
+
+    def save(self, snapshot, step):
+        """Starts writing snapshot in the background. Only one write runs at a time, a save
+        while the previous one is still writing waits for it first. Call wait before taking a
+        snapshot with a trainer, its replay copy needs the previous write to be done"""
+        self.wait()
+        self.thread = threading.Thread(target=self.write, args=(snapshot, step), daemon=True)
+        self.thread.start()
+
+    def write(self, snapshot, step):
+        try:
+            name = 'checkpoint_%09d' % step
+            write_snapshot(os.path.join(self.directory, name), snapshot)
+
+            # The pointer is replaced in one step, it always names a complete checkpoint
+            pointer = os.path.join(self.directory, latest_file)
+            with open(pointer + '.tmp', 'w') as f:
+                f.write(name)
+            os.replace(pointer + '.tmp', pointer)
+
+            for old in checkpoint_paths(self.directory)[:-self.keep]:
+                shutil.rmtree(old)
+        except Exception as error:
+            self.error = error
+
+    def wait(self):
+        """Waits for the checkpoint being written, raises the error if writing it failed"""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+def checkpoint_paths(directory):
+    return sorted(path for path in glob.glob(os.path.join(directory, 'checkpoint_*'))
+                  if not path.endswith('.tmp'))
+
+
+def latest_checkpoint(directory):
+    """Path of the newest complete checkpoint in directory, None if there is none"""
+    pointer = os.path.join(directory, latest_file)
+    if not os.path.exists(pointer):
+        return None
+    with open(pointer) as f:
+        return os.path.join(directory, f.read().strip())
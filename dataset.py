@@ -0,0 +1,178 @@
+# =============================================================================#
+# Name        : dataset.py                                                     #
+# Description : On-disk transition shards and a prefetching minibatch loader   #
+# ---------------------------------------------------------------------------- #
+# Transitions are written to chunked .npy shards holding one structured array  #
+# each, with the same fields as the replay buffer. Shards are memory-mapped    #
+# when read, so a dataset can be far larger than RAM.                          #
+# =============================================================================#
+
+import argparse
+import glob
+import os
+import queue
+import threading
+
+import numpy as np
+
+from replay_buffer import state_dtype
+
+
+# Fields of a stored transition, in the order DQNAgent.store takes them. The states have the dtype
+# the replay buffer stores them with
+def transition_dtype(state):
+    state = np.asarray(state)
+    return np.dtype([('state', state_dtype(state), state.shape),
+                     ('action', np.int64),
+                     ('reward', np.float32),
+                     ('next_state', state_dtype(state), state.shape),
+                     ('terminated', bool),
+                     ('bumpiness', np.float32),
+                     ('total_height', np.float32),
+                     ('total_holes', np.float32)])
+
+
+class ShardWriter(object):
+    """Buffers transitions and writes them to numbered shards of shard_size transitions"""
+
+    def __init__(self, directory, shard_size=100000):
+        self.directory = directory
+        self.shard_size = shard_size
+        os.makedirs(directory, exist_ok=True)
+
+        # Continue the numbering of shards already in the directory
+        self.shard_index = len(shard_paths(directory))
+        self.buffer = None
+        self.size = 0
+
+    def store(self, state, action, reward, next_state, terminated, bumpiness, total_height, total_holes):
+        if self.buffer is None:
+            self.buffer = np.zeros(self.shard_size, dtype=transition_dtype(state))
+
+        self.buffer[self.size] = (state, action, reward, next_state, terminated, bumpiness, total_height,
+                                  total_holes)
+        self.size += 1
+        if self.size == self.shard_size:
+            self.flush()
+
+    def store_batch(self, states, actions, rewards, next_states, terminated, bumpiness, total_height, total_holes):
+        columns = (states, actions, rewards, next_states, terminated, bumpiness, total_height, total_holes)
+        if self.buffer is None:
+            self.buffer = np.zeros(self.shard_size, dtype=transition_dtype(np.asarray(states)[0]))
+
+        start = 0
+        while start < len(actions):
+            n = min(len(actions) - start, self.shard_size - self.size)
+            for name, column in zip(self.buffer.dtype.names, columns):
+                self.buffer[name][self.size:self.size + n] = column[start:start + n]
+            self.size += n
+            start += n
+            if self.size == self.shard_size:
+                self.flush()
+
+    def flush(self):
+        """Writes the buffered transitions as a new shard"""
+        if not self.size:
+            return
+        np.save(os.path.join(self.directory, 'shard_%05d.npy' % self.shard_index), self.buffer[:self.size])
+        self.shard_index += 1
+        self.size = 0
+
+
+def shard_paths(directory):
+    return sorted(glob.glob(os.path.join(directory, 'shard_*.npy')))
+
+
+class ShardedDataset(object):
+    """All shards of a directory, memory-mapped and indexed as one array of transitions"""
+
+    def __init__(self, directory):
+        self.shards = [np.load(path, mmap_mode='r') for path in shard_paths(directory)]
+        if not self.shards:
+            raise ValueError("No shards in %s" % directory)
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def get_batch(self, indices):
+        """Returns the columns of the given transitions, in the same order as ReplayBuffer.get_batch"""
+        shard_of = np.searchsorted(self.offsets, indices, side='right') - 1
+        records = np.empty(len(indices), dtype=self.shards[0].dtype)
+        for shard in np.unique(shard_of):
+            rows = shard_of == shard
+            records[rows] = self.shards[shard][indices[rows] - self.offsets[shard]]
+        return tuple(records[name] for name in records.dtype.names)
+
+
+class StreamingLoader(object):
+    """Samples random minibatches from a dataset in a background thread, prefetch batches ahead"""
+
+    def __init__(self, dataset, batch_size, prefetch=8, seed=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.rng = np.random.default_rng(seed)
+        self.batches = queue.Queue(maxsize=prefetch)
+        self.stop_event = threading.Event()
+        # The error that stopped the background thread, raised by __next__
+        self.error = None
+        self.thread = threading.Thread(target=self.fill, daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        while not self.stop_event.is_set():
+            try:
+                self.batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def fill(self):
+        while not self.stop_event.is_set():
+            indices = np.sort(self.rng.integers(len(self.dataset), size=self.batch_size))
+            try:
+                batch = self.dataset.get_batch(indices)
+            except Exception as error:
+                # None after the batches already sampled tells __next__ to raise the error
+                self.error = error
+                self.put(None)
+                return
+            self.put(batch)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.error is not None and self.batches.empty():
+            raise self.error
+        batch = self.batches.get()
+        if batch is None:
+            raise self.error
+        return batch
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+
+
+# Pretrains or fine-tunes a model on logged transitions
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train a DQN agent offline from transition shards')
+    parser.add_argument('directory', help='Directory with the shards')
+    parser.add_argument('--load', default=None, help='Model to start from')
+    parser.add_argument('--save', default='offline_q_network.h5', help='Name to save the trained model as')
+    parser.add_argument('--steps', type=int, default=10000, help='Number of minibatches to train on')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--target-sync-every', type=int, default=1000)
+    args = parser.parse_args()
+
+    from dqn_agent import DQNAgent
+
+    agent = DQNAgent(args.load) if args.load else DQNAgent()
+    loader = StreamingLoader(ShardedDataset(args.directory), args.batch_size)
+    for step in range(1, args.steps + 1):
+        agent.train_on_batch(next(loader))
+        if step % args.target_sync_every == 0:
+            agent.align_target_model()
+    loader.close()
+    agent.save_model(args.save)
@@ -5,27 +5,55 @@
 # Date        : 21.10.2019                                                     #
 # ---------------------------------------------------------------------------- #
 
-from keras.models import Sequential, load_model
-from keras.layers import Dense
-from collections import deque
+import os
+from replay_buffer import ReplayBuffer, PrioritizedReplayBuffer
+import numpy_network
 import numpy as np
 import random
 
+# Network backend, 'keras' or 'numpy'. The NumPy backend never imports Keras or TensorFlow,
+# which takes process startup from seconds to milliseconds
+default_backend = os.environ.get('DQN_BACKEND', 'keras')
+
 
 class DQNAgent:
 
-    # If no string is given then no model is loaded
-    def __init__(self, string=0):
+    # If no string is given then no model is loaded.
+    # With prioritized replay the minibatches are sampled proportional to their TD errors.
+    # The action mode is 'micro' for the five moves of TetrisApp.play, or 'placement' where the
+    # network scores the board features after each final position of a stone.
+    # The backend is 'keras' or 'numpy', both load models saved as .h5 by Keras or as .npz by the NumPy backend
+    def __init__(self, string=0, memory_size=2000, prioritized=False, action_mode='micro', backend=None):
+        if action_mode not in ('micro', 'placement'):
+            raise ValueError("Unknown action mode: %s" % action_mode)
+        if backend is None:
+            backend = default_backend
+        if backend not in ('keras', 'numpy'):
+            raise ValueError("Unknown backend: %s" % backend)
 
         # Initialize attributes
         self.start_size = 1000
-        self.memory_size = 2000
-        self.experience_replay = deque(maxlen=self.memory_size)
+        self.memory_size = memory_size
+        self.prioritized = prioritized
+        if prioritized:
+            self.experience_replay = PrioritizedReplayBuffer(self.memory_size)
+        else:
+            self.experience_replay = ReplayBuffer(self.memory_size)
+        # Set to a dataset.ShardWriter to also keep every stored transition on disk
+        self.transition_log = None
+        # NumPy copy of the Q-network weights for acting, replaced as a whole after every update
+        self.inference_weights = None
         self.discount = 0.95
         self.neurons = [32, 32]
         self.loss = 'mse'
         self.optimizer = 'adam'
-        self.actions = [0, 1, 2, 3, 4]
+        self.action_mode = action_mode
+        self.backend = backend
+        if action_mode == 'micro':
+            self.actions = [0, 1, 2, 3, 4]
+        else:
+            # A placement agent learns a single value, stored as action 0
+            self.actions = [0]
 
         # Initialize discount exploration rate
         self.epsilon = 0.2
@@ -34,11 +62,12 @@ class DQNAgent:
         # If you want to load a saved model
         if not string == 0:
             # Load the model from string
-            self.q_network = load_model(string)
+            self.q_network = self.load_model(string)
             print("Loaded model with name: ", string)
 
-            # Build networks
+            # Build networks, the target network gets the input size of the loaded one
             self.target_network = self.build_model()
+            self.build_network(self.target_network, self.input_dim(self.q_network))
             self.align_target_model()
         else:
             # Build networks
@@ -47,22 +76,111 @@ class DQNAgent:
             self.align_target_model()
 
     def store(self, state, action, reward, next_state, terminated, bumpiness, total_height, total_holes):
-        self.experience_replay.append((state, action, reward, next_state, terminated, bumpiness, total_height,
-                                       total_holes))
+        self.experience_replay.store(state, action, reward, next_state, terminated, bumpiness, total_height,
+                                     total_holes)
+        if self.transition_log is not None:
+            self.transition_log.store(state, action, reward, next_state, terminated, bumpiness, total_height,
+                                      total_holes)
+
+    def store_batch(self, states, actions, rewards, next_states, terminated, bumpiness, total_height, total_holes):
+        self.experience_replay.store_batch(states, actions, rewards, next_states, terminated, bumpiness,
+                                           total_height, total_holes)
+        if self.transition_log is not None:
+            self.transition_log.store_batch(states, actions, rewards, next_states, terminated, bumpiness,
+                                            total_height, total_holes)
+
+    def layer_units(self):
+        if self.action_mode == 'micro':
+            return [self.neurons[0], self.neurons[0], self.neurons[0]]
+        return [self.neurons[0], self.neurons[0], 1]
 
     def build_model(self):
+        if self.backend == 'numpy':
+            return numpy_network.NumpyNetwork(self.layer_units(), ['relu', 'relu', 'linear'],
+                                              optimizer=self.optimizer)
+
+        # Imported here so the NumPy backend runs without Keras
+        from keras.models import Sequential
+        from keras.layers import Dense
 
         model = Sequential()
         model.add(Dense(self.neurons[0], activation='relu'))
         model.add(Dense(self.neurons[0], activation='relu'))
-        model.add(Dense(self.neurons[0], activation='linear'))
+        if self.action_mode == 'micro':
+            model.add(Dense(self.neurons[0], activation='linear'))
+        else:
+            model.add(Dense(1, activation='linear'))
 
         model.compile(loss=self.loss, optimizer=self.optimizer)
 
         return model
 
+    def load_model(self, path):
+        if self.backend == 'numpy':
+            return numpy_network.NumpyNetwork.load(path, optimizer=self.optimizer)
+
+        if numpy_network.is_numpy_export(path):
+            # A NumPy export, the weights go into a freshly built Keras model
+            weights, activations = numpy_network.load_weights(path)
+            model = self.build_model()
+            self.build_network(model, weights[0].shape[0])
+            model.set_weights(weights)
+            return model
+
+        # Compiled again here, Keras 3 can not deserialize the loss of older .h5 files
+        from keras.models import load_model
+        model = load_model(path, compile=False)
+        model.compile(loss=self.loss, optimizer=self.optimizer)
+        return model
+
+    def input_dim(self, network):
+        return network.get_weights()[0].shape[0]
+
+    def build_network(self, network, input_dim):
+        if not network.built:
+            network.predict_on_batch(np.zeros((1, input_dim), dtype=np.float32))
+
     def align_target_model(self):
-        self.target_network.set_weights(self.q_network.get_weights())
+        weights = self.q_network.get_weights()
+        if weights:
+            # A Keras target network has no weights to set before it has seen an input
+            self.build_network(self.target_network, weights[0].shape[0])
+        self.target_network.set_weights(weights)
+
+    def soft_update_target(self, tau):
+        """Moves the target network the fraction tau of the way towards the Q-network"""
+        weights = [tau * w + (1 - tau) * t
+                   for w, t in zip(self.q_network.get_weights(), self.target_network.get_weights())]
+        self.target_network.set_weights(weights)
+
+    def set_weights(self, weights):
+        self.q_network.set_weights(weights)
+        self.inference_weights = None
+
+    def publish_weights(self):
+        """Copies the Q-network weights for acting. Replacing the copy is atomic, so acting on another
+        thread never sees the weights of an update that is only half done"""
+        if self.backend == 'numpy':
+            self.inference_activations = self.q_network.activations
+        else:
+            self.inference_activations = [layer.activation.__name__ for layer in self.q_network.layers]
+        self.inference_weights = self.q_network.get_weights()
+
+    def q_values(self, inputs):
+        """Q-values of a batch of network inputs, from a NumPy forward pass without the Keras predict overhead"""
+        inputs = np.asarray(inputs, dtype=np.float32)
+        if inputs.ndim != 2:
+            raise ValueError("The network takes a batch of input rows, not an array of shape %s" % (inputs.shape,))
+        weights = self.inference_weights
+        if weights is None:
+            # The first call builds the network if it has not seen any input yet
+            if not self.q_network.built:
+                self.q_network.predict_on_batch(inputs)
+            self.publish_weights()
+            weights = self.inference_weights
+        if inputs.shape[1] != weights[0].shape[0]:
+            raise ValueError("The network takes %d inputs per row, not %d" % (weights[0].shape[0], inputs.shape[1]))
+        return numpy_network.forward(weights, self.inference_activations, inputs)
 
     # Exploration function
     def act(self, state):
@@ -70,25 +188,77 @@ class DQNAgent:
         if np.random.rand() <= self.epsilon:
             return random.choice(self.actions)
         else:
-            q_values = self.q_network.predict(state)
+            q_values = self.q_values(state)
             return np.argmax(q_values[0][self.actions])
 
+    def act_batch(self, states):
+        """Returns an action for each state of a batch, for example one state per environment,
+        with epsilon-greedy exploration drawn for all states at once. Every state has the shape
+        of TetrisApp.observe, as the states of VecTetris do"""
+        states = np.asarray(states)
+        if states.ndim != 3:
+            raise ValueError("Expected a batch of states of shape (states, rows, inputs), not %s" % (states.shape,))
+        q_values = self.q_values(states.reshape((-1,) + states.shape[2:])).reshape((len(states), states.shape[1], -1))
+        actions = np.array(self.actions)[np.argmax(q_values[:, 0, self.actions], axis=1)]
+
+        explore = np.random.rand(len(states)) <= self.epsilon
+        actions[explore] = np.random.choice(self.actions, size=np.count_nonzero(explore))
+        return actions
+
+    def act_placement(self, placement_features):
+        """Returns the index of the best placement, all candidates are scored in one forward pass"""
+        if np.random.rand() <= self.epsilon:
+            return random.randrange(len(placement_features))
+        else:
+            values = self.q_values(np.array(placement_features, dtype=np.float32))
+            return int(np.argmax(values[:, 0]))
+
     def retrain(self, batch_size):
-        """Training the agent"""
-        mini_batch = random.sample(self.experience_replay, batch_size)
+        """Training the agent on one minibatch from the experience replay"""
+        batch, indices, weights = self.experience_replay.sample_weighted(batch_size)
+        self.train_on_batch(batch, indices, weights)
 
-        for state, action, reward, next_state, terminated, bumpiness, total_height, total_holes in mini_batch:
-            target = self.q_network.predict(state)
+    def train_on_batch(self, batch, indices=None, weights=None):
+        """Training the agent on a minibatch of transition columns with a single forward pass per network.
+        The batch can come from the experience replay or from a dataset.StreamingLoader. Returns the TD errors"""
+        states, actions, rewards, next_states, terminated = batch[:5]
 
-            if terminated:
-                target[0][action] = reward
-            else:
-                t = self.target_network.predict(next_state)
-                target[0][action] = reward + self.gamma * np.amax(t)
+        # Every stored state is a batch of its own for the network, so the samples are stacked
+        # along the first axis and split up again after the forward pass
+        batch_size = len(actions)
+        samples = np.arange(batch_size)
+        rows_per_state = states.shape[1]
+        inputs = states.reshape((-1,) + states.shape[2:])
+        targets = self.q_network.predict_on_batch(inputs).reshape((batch_size, rows_per_state, -1))
+        t = self.target_network.predict_on_batch(next_states.reshape((-1,) + next_states.shape[2:]))
+        t = t.reshape((batch_size, -1))
 
-            self.q_network.fit(state, target, epochs=1, verbose=0)
+        # Bellman targets, only the first row of each sample's prediction is trained like before
+        bellman = np.where(terminated, rewards, rewards + self.gamma * np.amax(t, axis=1))
+        td_errors = bellman - targets[samples, 0, actions]
+        targets[samples, 0, actions] = bellman
+        if indices is not None:
+            self.experience_replay.update_priorities(indices, td_errors)
+
+        # The importance-sampling weights apply to every row of a sample
+        if weights is not None:
+            weights = np.repeat(weights, rows_per_state)
+        self.q_network.train_on_batch(inputs, targets.reshape((inputs.shape[0], -1)), sample_weight=weights)
+        self.publish_weights()
+        return td_errors
 
     def save_model(self, name):
-        # save model and architecture to single file
+        # save model and architecture to single file, the NumPy backend always writes an .npz file
+        if self.backend == 'numpy':
+            name = os.path.splitext(name)[0] + '.npz'
         self.q_network.save(name)
         print("Saved model to disk as: ", name)
+
+    def export_weights(self, name):
+        """Saves the Q-network weights as a compact .npz file that loads without Keras"""
+        if self.backend == 'numpy':
+            activations = self.q_network.activations
+        else:
+            activations = [layer.activation.__name__ for layer in self.q_network.layers]
+        numpy_network.save_weights(name, self.q_network.get_weights(), activations)
+        print("Exported weights to disk as: ", name)
@@ -0,0 +1,204 @@
+# =============================================================================#
+# Name        : episode_log.py                                                 #
+# Description : Compact binary episode logs with offline replay and rendering  #
+# ---------------------------------------------------------------------------- #
+# A log holds a header with the episode seed, the board size and the reward    #
+# weights of the game, followed by one action byte per step, and optionally    #
+# the reward and the bumpiness/height/holes of every step as float32 arrays.   #
+# The arrays are memory-mapped when a log is loaded.                           #
+# =============================================================================#
+
+import argparse
+import array
+import os
+import struct
+
+import numpy as np
+import pygame
+
+import tetris_game
+
+# Magic, version, flags, rows, cols, episode seed, steps and from version 2 on the four reward weights,
+# padded to a multiple of four bytes. Version 1 logs were played with the default reward weights
+header_formats = {
+    1: struct.Struct('<4sBBHHQI10x'),
+    2: struct.Struct('<4sBBHHQI4d10x')
+}
+magic = b'TTRS'
+version = 2
+header_format = header_formats[version]
+
+# Header flags
+flag_placement = 1
+flag_bag = 2
+flag_rewards = 4
+flag_features = 8
+
+
+def padded(n):
+    # Every array starts at a multiple of four bytes so the float arrays are aligned
+    return (n + 3) // 4 * 4
+
+
+class EpisodeRecorder(object):
+    """Keeps the current episode of a TetrisApp in memory, attach it with TetrisApp.set_recorder"""
+
+    def __init__(self, action_mode='micro', rewards=True, features=True):
+        self.action_mode = action_mode
+        self.keep_rewards = rewards
+        self.keep_features = features
+        self.seed = None
+        self.bag = False
+        self.cols = tetris_game.cols
+        self.rows = tetris_game.rows
+        self.reward_weights = tetris_game.reward_weights
+        self.actions = bytearray()
+        self.rewards = array.array('f')
+        self.features = array.array('f')
+
+    def start(self, seed, bag, cols=tetris_game.cols, rows=tetris_game.rows,
+              reward_weights=tetris_game.reward_weights):
+        self.seed = seed
+        self.bag = bag
+        self.cols = cols
+        self.rows = rows
+        self.reward_weights = tuple(reward_weights)
+        self.actions = bytearray()
+        self.rewards = array.array('f')
+        self.features = array.array('f')
+
+    def record(self, action, reward, bumpiness, height, holes):
+        self.actions.append(action)
+        if self.keep_rewards:
+            self.rewards.append(reward)
+        if self.keep_features:
+            self.features.extend((bumpiness, height, holes))
+
+    def __len__(self):
+        return len(self.actions)
+
+    def save(self, path):
+        """Writes the current episode to path"""
+        flags = 0
+        if self.action_mode == 'placement':
+            flags |= flag_placement
+        if self.bag:
+            flags |= flag_bag
+        if self.keep_rewards:
+            flags |= flag_rewards
+        if self.keep_features:
+            flags |= flag_features
+
+        with open(path, 'wb') as f:
+            f.write(header_format.pack(magic, version, flags, self.rows, self.cols,
+                                       self.seed, len(self.actions), *self.reward_weights))
+            f.write(bytes(self.actions))
+            f.write(bytes(padded(len(self.actions)) - len(self.actions)))
+            if self.keep_rewards:
+                f.write(self.rewards.tobytes())
+            if self.keep_features:
+                f.write(self.features.tobytes())
+
+
+class EpisodeLog(object):
+    """A recorded episode, with the arrays memory-mapped from the file"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            header = f.read(max(header.size for header in header_formats.values()))
+        file_version = header[4] if len(header) > 4 else None
+        if header[:4] != magic or file_version not in header_formats:
+            raise ValueError("Not an episode log: %s" % path)
+        file_header = header_formats[file_version]
+        values = file_header.unpack(header[:file_header.size])
+        flags, self.rows, self.cols, self.seed, self.steps = values[2:7]
+        self.reward_weights = tuple(values[7:]) or tetris_game.reward_weights
+
+        self.placement = bool(flags & flag_placement)
+        self.bag = bool(flags & flag_bag)
+
+        offset = file_header.size
+        self.actions = np.memmap(path, dtype=np.uint8, mode='r', offset=offset, shape=(self.steps,))
+        offset += padded(self.steps)
+
+        self.rewards = None
+        if flags & flag_rewards:
+            self.rewards = np.memmap(path, dtype=np.float32, mode='r', offset=offset, shape=(self.steps,))
+            offset += 4 * self.steps
+
+        # Bumpiness, height and holes of every step
+        self.features = None
+        if flags & flag_features:
+            self.features = np.memmap(path, dtype=np.float32, mode='r', offset=offset, shape=(self.steps, 3))
+
+    def __len__(self):
+        return self.steps
+
+    def play_step(self, environment, step):
+        action = int(self.actions[step])
+        if self.placement:
+            return environment.play_placement(action >> 4, action & 15)
+        return environment.play(action)
+
+    def replay(self, environment, to_step=None):
+        """Starts the episode on environment and plays it headless up to, but not including, to_step.
+        The environment needs the board size, reward weights and randomizer of the recorded game"""
+        if (self.rows, self.cols) != (environment.rows, environment.cols):
+            raise ValueError("The log was recorded on a %dx%d board" % (self.cols, self.rows))
+        if tuple(environment.reward_weights) != self.reward_weights:
+            raise ValueError("The log was recorded with the reward weights %s" % (self.reward_weights,))
+        if environment.pieces.bag != self.bag:
+            raise ValueError("The log was recorded %s the 7-bag randomizer" % ('with' if self.bag else 'without'))
+
+        render_every = environment.render_every
+        environment.render_every = 0
+        try:
+            environment.start_game(False, seed=self.seed)
+            for step in range(self.steps if to_step is None else min(to_step, self.steps)):
+                self.play_step(environment, step)
+        finally:
+            environment.render_every = render_every
+        return environment
+
+
+# ================================================================================================#
+#                                       Viewer and Exporter                                      #
+# ================================================================================================#
+
+def view_episode(path, start_step=0, every=1, fps=tetris_game.max_fps, export_dir=None):
+    """Jumps to start_step without rendering and shows the rest of the episode through render_game,
+    one frame every `every` steps. With export_dir the frames are saved as images instead"""
+    if export_dir is not None:
+        # Frames are only saved, so no real window is needed
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+        os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+        os.makedirs(export_dir, exist_ok=True)
+
+    log = EpisodeLog(path)
+    environment = tetris_game.TetrisApp(headless=True, bag=log.bag, cols=log.cols, rows=log.rows,
+                                        reward_weights=log.reward_weights)
+    log.replay(environment, start_step)
+    environment.init_display()
+    # render_game keeps to the frame rate, saved frames are written as fast as possible
+    environment.max_fps = fps if export_dir is None else 0
+
+    for step in range(start_step, len(log)):
+        log.play_step(environment, step)
+        if (step - start_step) % every == 0:
+            environment.render_game()
+            if export_dir is not None:
+                pygame.image.save(environment.screen, os.path.join(export_dir, 'step_%06d.png' % step))
+        if environment.stop_ai:
+            break
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a recorded episode')
+    parser.add_argument('path', help='Episode log to replay')
+    parser.add_argument('--start', type=int, default=0, help='Step to jump to before rendering')
+    parser.add_argument('--every', type=int, default=1, help='Steps per rendered frame')
+    parser.add_argument('--fps', type=int, default=tetris_game.max_fps, help='Frames per second, 0 for no limit')
+    parser.add_argument('--export', default=None, help='Directory to save the frames to instead of showing them')
+    args = parser.parse_args()
+
+    view_episode(args.path, args.start, args.every, args.fps, args.export)
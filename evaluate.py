@@ -0,0 +1,155 @@
+# =============================================================================#
+# Name        : evaluate.py                                                    #
+# Description : Scores saved models over many seeded games in parallel         #
+# ---------------------------------------------------------------------------- #
+# Every model plays the same seeded games greedily and headless, spread over   #
+# a pool of processes that each load the model once. The workers use the NumPy #
+# backend by default, so they start without importing Keras.                   #
+# =============================================================================#
+
+import argparse
+import json
+import multiprocessing as mp
+import random
+import time
+
+import numpy as np
+
+from tetris_game import cols, rows, reward_weights
+
+# Configuration
+num_games = 200
+max_steps_per_game = 20000
+
+# The agent of a worker process, loaded once by init_worker
+worker_agent = None
+worker_options = None
+
+
+# Plays one greedy game from the episode seed and returns its lines, pieces, reward and steps
+def play_game(environment, agent, seed, max_steps=max_steps_per_game):
+    environment.start_game(False, seed=seed)
+    state = environment.observe()
+    total_reward = 0.0
+    steps = 0
+
+    while steps < max_steps:
+        environment.reset_reward()
+        if agent.action_mode == 'placement':
+            placements = environment.get_placements()
+            if not placements:
+                break
+            rotation, x, features = placements[agent.act_placement([p[2] for p in placements])]
+            state, reward, terminated = environment.play_placement(rotation, x)[:3]
+        else:
+            state, reward, terminated = environment.play(agent.act(state))[:3]
+        total_reward += reward
+        steps += 1
+        if terminated or environment.quit():
+            break
+
+    return environment.get_number_of_lines(), environment.get_number_of_pieces(), total_reward, steps
+
+
+def game_seeds(seed, games):
+    # The same seeds for every model, so all of them play the same stone sequences
+    seed_generator = random.Random(seed)
+    return [seed_generator.getrandbits(32) for _ in range(games)]
+
+
+# ================================================================================================#
+#                                       Worker Processes                                         #
+# ================================================================================================#
+
+def init_worker(path, options):
+    global worker_agent, worker_options
+    from dqn_agent import DQNAgent
+
+    worker_agent = DQNAgent(path, memory_size=1, action_mode=options['action_mode'], backend=options['backend'])
+    worker_agent.epsilon = 0.0
+    worker_options = options
+
+
+def run_games(seeds):
+    from tetris_game import TetrisApp
+
+    environment = TetrisApp(headless=True, engine='bitboard', obs_mode=worker_options['obs_mode'],
+                            cols=worker_options['cols'], rows=worker_options['rows'],
+                            reward_weights=worker_options['reward_weights'])
+    return [(seed,) + play_game(environment, worker_agent, seed, worker_options['max_steps']) for seed in seeds]
+
+
+# ================================================================================================#
+#                                          Evaluation                                            #
+# ================================================================================================#
+
+def distribution(values):
+    values = np.asarray(values, dtype=np.float64)
+    p25, p50, p75 = np.percentile(values, (25, 50, 75))
+    return {'mean': values.mean(), 'std': values.std(), 'min': values.min(), 'p25': p25, 'median': p50,
+            'p75': p75, 'max': values.max()}
+
+
+def evaluate(path, games=num_games, workers=None, seed=0, max_steps=max_steps_per_game, obs_mode='position',
+             action_mode='micro', backend='numpy', cols=cols, rows=rows, reward_weights=reward_weights):
+    """Plays games seeded games with the model at path on a cols x rows board and returns a summary
+    of the results, with the rewards weighted by reward_weights"""
+    if workers is None:
+        workers = mp.cpu_count()
+    options = {'obs_mode': obs_mode, 'action_mode': action_mode, 'backend': backend, 'max_steps': max_steps,
+               'cols': cols, 'rows': rows, 'reward_weights': tuple(reward_weights)}
+    seeds = game_seeds(seed, games)
+    chunks = [seeds[i:i + 4] for i in range(0, len(seeds), 4)]
+
+    start_timer = time.time()
+    context = mp.get_context('spawn')
+    with context.Pool(workers, initializer=init_worker, initargs=(path, options)) as pool:
+        results = [game for chunk in pool.imap_unordered(run_games, chunks) for game in chunk]
+    total_time = time.time() - start_timer
+
+    results.sort()
+    seeds, lines, pieces, rewards, steps = zip(*results)
+    return {'model': path, 'games': games, 'seed': seed, 'cols': cols, 'rows': rows,
+            'reward_weights': list(reward_weights), 'seconds': total_time, 'games_per_second': games / total_time,
+            'steps_per_second': sum(steps) / total_time, 'lines': distribution(lines),
+            'pieces': distribution(pieces), 'reward': distribution(rewards)}
+
+
+def print_summary(summary):
+    print("______________________________________")
+    print("Model: ", summary['model'])
+    print("Games: ", summary['games'], "in", round(summary['seconds'], 2), "seconds,",
+          round(summary['games_per_second'], 1), "games per second")
+    for name in ('lines', 'pieces', 'reward'):
+        values = summary[name]
+        print("%-7s mean %9.2f  std %9.2f  min %9.2f  median %9.2f  max %9.2f" %
+              (name, values['mean'], values['std'], values['min'], values['median'], values['max']))
+    print("______________________________________")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score saved models over many seeded headless games')
+    parser.add_argument('models', nargs='+', help='Saved models (.h5 or .npz) to evaluate')
+    parser.add_argument('--games', type=int, default=num_games)
+    parser.add_argument('--workers', type=int, default=None, help='Processes, defaults to the number of CPUs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-steps', type=int, default=max_steps_per_game, help='Actions allowed per game')
+    parser.add_argument('--obs-mode', default='position', choices=['position', 'features', 'board'])
+    parser.add_argument('--action-mode', default='micro', choices=['micro', 'placement'])
+    parser.add_argument('--backend', default='numpy', choices=['keras', 'numpy'])
+    parser.add_argument('--cols', type=int, default=cols, help='Board width the models were trained on')
+    parser.add_argument('--rows', type=int, default=rows, help='Board height the models were trained on')
+    parser.add_argument('--reward-weights', type=float, nargs=4, default=reward_weights,
+                        help='Weights of height, lines, holes and bumpiness')
+    parser.add_argument('--output', default=None, help='JSON lines file to append the summaries to')
+    args = parser.parse_args()
+    if args.max_steps < 1:
+        parser.error('--max-steps must be at least 1')
+
+    for model in args.models:
+        result = evaluate(model, args.games, args.workers, args.seed, args.max_steps, args.obs_mode,
+                          args.action_mode, args.backend, args.cols, args.rows, args.reward_weights)
+        print_summary(result)
+        if args.output is not None:
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(result) + '\n')
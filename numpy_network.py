@@ -0,0 +1,211 @@
+# =============================================================================#
+# Name        : numpy_network.py                                               #
+# Description : NumPy forward pass and training for the small dense Q-networks #
+# ---------------------------------------------------------------------------- #
+# NumpyNetwork has the parts of the Keras model API that DQNAgent uses, so an  #
+# agent can act and train without importing Keras or TensorFlow. Weights are   #
+# loaded from a model saved by Keras (.h5) or from a compact .npz export.      #
+# =============================================================================#
+
+import json
+import zipfile
+
+import numpy as np
+
+activation_functions = {
+    'relu': lambda x: np.maximum(x, 0, out=x),
+    'linear': lambda x: x
+}
+
+
+def forward(weights, activations, inputs):
+    """Runs inputs through dense layers given as the flat [kernel, bias, kernel, bias, ...] list
+    Keras get_weights returns, with one activation name per layer"""
+    x = np.asarray(inputs, dtype=np.float32)
+    for layer, activation in enumerate(activations):
+        x = x @ weights[2 * layer] + weights[2 * layer + 1]
+        x = activation_functions[activation](x)
+    return x
+
+
+# ================================================================================================#
+#                                       Saved Weights                                            #
+# ================================================================================================#
+
+def save_weights(path, weights, activations):
+    """Writes the weights and activations of a dense network as a compact .npz file"""
+    arrays = {'weight_%d' % i: np.asarray(w, dtype=np.float32) for i, w in enumerate(weights)}
+    # Written through a file object so np.savez keeps the name as given
+    with open(path, 'wb') as f:
+        np.savez(f, activations=np.array(activations), **arrays)
+
+
+def is_numpy_export(path):
+    # Native Keras .keras files are zip files too, an export is told apart by its activations
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as saved:
+        return 'activations.npy' in saved.namelist()
+
+
+def load_weights(path):
+    """Returns (weights, activations) of a network saved with save_weights or by Keras as .h5"""
+    if is_numpy_export(path):
+        with np.load(path) as saved:
+            activations = [str(activation) for activation in saved['activations']]
+            weights = [saved['weight_%d' % i] for i in range(2 * len(activations))]
+        return weights, activations
+
+    if zipfile.is_zipfile(path):
+        raise ValueError("%s is a native Keras file, load it with the Keras backend or save it as .h5" % path)
+
+    # Read straight from the HDF5 layout Keras writes, h5py comes with Keras but is light to import
+    import h5py
+
+    with h5py.File(path, 'r') as f:
+        config = json.loads(f.attrs['model_config'])
+        activations = [layer['config']['activation'] for layer in config['config']['layers']
+                       if layer['class_name'] == 'Dense']
+        group = f['model_weights'] if 'model_weights' in f else f
+        weights = []
+        for layer_name in group.attrs['layer_names']:
+            layer = group[layer_name]
+            for weight_name in layer.attrs['weight_names']:
+                weights.append(np.array(layer[weight_name], dtype=np.float32))
+    return weights, activations
+
+
+# ================================================================================================#
+#                                       NumPy Network                                            #
+# ================================================================================================#
+
+class NumpyNetwork(object):
+    """Dense network trained on mean squared error with Adam or SGD. Like a Keras Sequential model
+    without an input layer, the weights are created when the first input is seen"""
+
+    def __init__(self, units, activations, optimizer='adam', learning_rate=0.001, seed=None):
+        if optimizer not in ('adam', 'sgd'):
+            raise ValueError("Unknown optimizer: %s" % optimizer)
+        self.units = list(units)
+        self.activations = list(activations)
+        self.optimizer = optimizer
+        self.learning_rate = learning_rate
+        self.rng = np.random.default_rng(seed)
+        self.weights = None
+        self.reset_optimizer()
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        weights, activations = load_weights(path)
+        network = cls([len(bias) for bias in weights[1::2]], activations, **kwargs)
+        network.set_weights(weights)
+        return network
+
+    @property
+    def built(self):
+        return self.weights is not None
+
+    def build(self, input_dim):
+        # Glorot uniform kernels and zero biases, the Keras Dense defaults
+        self.weights = []
+        for units in self.units:
+            limit = np.sqrt(6.0 / (input_dim + units))
+            self.weights.append(self.rng.uniform(-limit, limit, size=(input_dim, units)).astype(np.float32))
+            self.weights.append(np.zeros(units, dtype=np.float32))
+            input_dim = units
+        self.reset_optimizer()
+
+    def reset_optimizer(self):
+        self.iterations = 0
+        self.moments = None
+        self.velocities = None
+
+    def get_weights(self):
+        # Like Keras, a network that is not built yet has no weights
+        if not self.built:
+            return []
+        return [w.copy() for w in self.weights]
+
+    def set_weights(self, weights):
+        if len(weights):
+            self.weights = [np.array(w, dtype=np.float32) for w in weights]
+
+    def predict_on_batch(self, inputs):
+        inputs = np.asarray(inputs, dtype=np.float32)
+        if not self.built:
+            self.build(inputs.shape[-1])
+        return forward(self.weights, self.activations, inputs)
+
+    def predict(self, inputs, verbose=0):
+        return self.predict_on_batch(inputs)
+
+    def train_on_batch(self, inputs, targets, sample_weight=None):
+        """One gradient step on the mean squared error, weighted per sample like Keras. Returns the loss"""
+        inputs = np.asarray(inputs, dtype=np.float32)
+        targets = np.asarray(targets, dtype=np.float32)
+        if not self.built:
+            self.build(inputs.shape[-1])
+
+        # Forward pass keeping the output of every layer
+        outputs = [inputs]
+        for layer, activation in enumerate(self.activations):
+            x = outputs[-1] @ self.weights[2 * layer] + self.weights[2 * layer + 1]
+            outputs.append(activation_functions[activation](x))
+
+        # Keras averages the squared error over the outputs and then over the batch
+        errors = outputs[-1] - targets
+        weights = np.ones(len(inputs), dtype=np.float32) if sample_weight is None else \
+            np.asarray(sample_weight, dtype=np.float32)
+        loss = float(np.mean(weights * np.mean(errors ** 2, axis=1)))
+        delta = errors * (2.0 / errors.size) * weights[:, None]
+
+        gradients = [None] * len(self.weights)
+        for layer in reversed(range(len(self.activations))):
+            if self.activations[layer] == 'relu':
+                delta = delta * (outputs[layer + 1] > 0)
+            gradients[2 * layer] = outputs[layer].T @ delta
+            gradients[2 * layer + 1] = delta.sum(axis=0)
+            if layer:
+                delta = delta @ self.weights[2 * layer].T
+
+        self.apply_gradients(gradients)
+        return loss
+
+    def apply_gradients(self, gradients):
+        self.iterations += 1
+        if self.optimizer == 'sgd':
+            for w, g in zip(self.weights, gradients):
+                w -= self.learning_rate * g
+            return
+
+        # Adam with the Keras defaults
+        beta_1, beta_2, epsilon = 0.9, 0.999, 1e-7
+        if self.moments is None:
+            self.moments = [np.zeros_like(w) for w in self.weights]
+            self.velocities = [np.zeros_like(w) for w in self.weights]
+        step = self.learning_rate * np.sqrt(1 - beta_2 ** self.iterations) / (1 - beta_1 ** self.iterations)
+        for w, g, m, v in zip(self.weights, gradients, self.moments, self.velocities):
+            m += (g - m) * (1 - beta_1)
+            v += (g * g - v) * (1 - beta_2)
+            w -= step * m / (np.sqrt(v) + epsilon)
+
+    def get_optimizer_state(self):
+        """The step count and the Adam moments as a list of arrays, for checkpoints"""
+        if self.moments is None:
+            return [np.array(self.iterations)]
+        return [np.array(self.iterations)] + [m.copy() for m in self.moments] + [v.copy() for v in self.velocities]
+
+    def set_optimizer_state(self, state):
+        self.iterations = int(state[0])
+        if len(state) > 1:
+            n = (len(state) - 1) // 2
+            self.moments = [np.array(m, dtype=np.float32) for m in state[1:1 + n]]
+            self.velocities = [np.array(v, dtype=np.float32) for v in state[1 + n:]]
+
+    def save(self, path):
+        save_weights(path, self.weights, self.activations)
+
+    def summary(self):
+        for layer, activation in enumerate(self.activations):
+            kernel = self.weights[2 * layer].shape if self.built else (None, self.units[layer])
+            print("dense_%d  %-12s %s" % (layer, activation, kernel))
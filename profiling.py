@@ -0,0 +1,160 @@
+# =============================================================================#
+# Name        : profiling.py                                                   #
+# Description : Timers, counters and cProfile windows for training runs        #
+# ---------------------------------------------------------------------------- #
+# Profiler.enable replaces the instrumented methods of TetrisApp and DQNAgent  #
+# with timed wrappers and disable puts the originals back, so nothing is paid  #
+# while profiling is off. Timings are summarised per episode as percentiles,   #
+# next to the counters of the episode, and written to a CSV or JSON lines file #
+# every export_every episodes.                                                 #
+# =============================================================================#
+
+import collections
+import contextlib
+import cProfile
+import csv
+import functools
+import json
+import sys
+import time
+
+import numpy as np
+
+# Methods timed by Profiler.enable
+tetris_app_methods = ['play', 'play_placement', 'drop', 'observe', 'get_reward', 'total_height', 'bumpiness',
+                      'number_of_holes', 'update_columns', 'raise_columns', 'rescan_columns', 'get_placements',
+                      'render_game']
+dqn_agent_methods = ['act', 'act_batch', 'act_placement', 'retrain', 'train_on_batch']
+
+summary_fields = ['episode', 'name', 'calls', 'total_ms', 'mean_us', 'p50_us', 'p90_us', 'p99_us', 'max_us']
+
+
+class Profiler(object):
+    """Times the instrumented methods and summarises every episode. path is a .csv or .jsonl file to
+    export the summaries to, profile_episodes a (first, last) range of episodes to run cProfile over,
+    with the stats saved to profile_to"""
+
+    def __init__(self, path=None, export_every=10, profile_episodes=None, profile_to='training.prof'):
+        self.path = path
+        self.export_every = export_every
+        self.profile_episodes = profile_episodes
+        self.profile_to = profile_to
+        self.samples = collections.defaultdict(list)
+        self.counters = collections.Counter()
+        self.pending = []
+        self.originals = []
+        self.profile = None
+
+    # ============================================================================================#
+    #                                       Instrumentation                                       #
+    # ============================================================================================#
+
+    def instrument(self, owner, names, prefix):
+        """Replaces the methods in names of owner with timed wrappers, recorded as prefix.name"""
+        for name in names:
+            function = getattr(owner, name)
+            self.originals.append((owner, name, function))
+            setattr(owner, name, self.timed(prefix + '.' + name, function))
+
+    def timed(self, name, function):
+        samples = self.samples
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                samples[name].append(time.perf_counter_ns() - start)
+        return wrapper
+
+    def enable(self):
+        """Instruments TetrisApp and DQNAgent, the agent is only instrumented if it is already imported"""
+        from tetris_game import TetrisApp
+
+        self.disable()
+        self.instrument(TetrisApp, tetris_app_methods, 'env')
+        if 'dqn_agent' in sys.modules:
+            self.instrument(sys.modules['dqn_agent'].DQNAgent, dqn_agent_methods, 'agent')
+
+    def disable(self):
+        for owner, name, function in reversed(self.originals):
+            setattr(owner, name, function)
+        self.originals = []
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Times a block of code, recorded under name"""
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.samples[name].append(time.perf_counter_ns() - start)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    # ============================================================================================#
+    #                                      Episode Summaries                                      #
+    # ============================================================================================#
+
+    def start_episode(self, episode):
+        if self.profile_episodes is not None and episode == self.profile_episodes[0]:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def end_episode(self, episode):
+        """Summarises the timings and counters of the episode and starts over, returns the summary rows"""
+        rows = []
+        for name, samples in sorted(self.samples.items()):
+            if not samples:
+                continue
+            micros = np.array(samples) / 1000.0
+            p50, p90, p99 = np.percentile(micros, (50, 90, 99))
+            rows.append({'episode': episode, 'name': name, 'calls': len(micros),
+                         'total_ms': micros.sum() / 1000.0, 'mean_us': micros.mean(), 'p50_us': p50,
+                         'p90_us': p90, 'p99_us': p99, 'max_us': micros.max()})
+        for name, value in sorted(self.counters.items()):
+            rows.append({'episode': episode, 'name': name, 'calls': value})
+        self.samples.clear()
+        self.counters.clear()
+
+        if self.profile is not None and episode >= self.profile_episodes[1]:
+            self.profile.disable()
+            self.profile.dump_stats(self.profile_to)
+            self.profile = None
+            print("Saved cProfile stats of episodes", self.profile_episodes, "as: ", self.profile_to)
+
+        if self.path is not None:
+            self.pending += rows
+            if (episode + 1) % self.export_every == 0:
+                self.export()
+        return rows
+
+    def export(self):
+        """Appends the summaries not written yet to path"""
+        if self.path is None or not self.pending:
+            return
+        if self.path.endswith('.csv'):
+            with open(self.path, 'a', newline='') as f:
+                writer = csv.DictWriter(f, summary_fields)
+                if f.tell() == 0:
+                    writer.writeheader()
+                writer.writerows(self.pending)
+        else:
+            with open(self.path, 'a') as f:
+                for row in self.pending:
+                    f.write(json.dumps(row) + '\n')
+        self.pending = []
+
+
+def print_summary(rows):
+    print("%-28s %9s %11s %10s %10s %10s %10s" % ('name', 'calls', 'total ms', 'mean us', 'p50 us', 'p90 us',
+                                                 'p99 us'))
+    for row in rows:
+        if 'total_ms' in row:
+            print("%-28s %9d %11.2f %10.2f %10.2f %10.2f %10.2f" % (row['name'], row['calls'], row['total_ms'],
+                                                                    row['mean_us'], row['p50_us'],
+                                                                    row['p90_us'], row['p99_us']))
+        else:
+            print("%-28s %9d" % (row['name'], row['calls']))
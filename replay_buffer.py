@@ -0,0 +1,284 @@
+# =============================================================================#
+# Name        : replay_buffer.py                                               #
+# Description : Experience replay memory for the DQN agent                     #
+# ---------------------------------------------------------------------------- #
+
+import numpy as np
+
+
+def state_dtype(state):
+    # States keep the dtype of the observation, like the uint8 board, wider types are stored as float32
+    dtype = np.asarray(state).dtype
+    if dtype.kind in 'biuf' and dtype.itemsize <= 4:
+        return dtype
+    return np.dtype(np.float32)
+
+
+class ReplayBuffer:
+    """Ring buffer of transitions stored in preallocated, typed NumPy columns"""
+
+    columns = ('states', 'actions', 'rewards', 'next_states', 'terminated', 'bumpiness', 'total_height',
+               'total_holes')
+
+    def __init__(self, capacity, seed=None):
+        self.capacity = capacity
+        self.rng = np.random.default_rng(seed)
+        self.position = 0
+        self.size = 0
+
+        # The columns are allocated on the first store, when the state shape is known
+        self.states = None
+        self.next_states = None
+        self.actions = np.zeros(capacity, dtype=np.int64)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.terminated = np.zeros(capacity, dtype=bool)
+        self.bumpiness = np.zeros(capacity, dtype=np.float32)
+        self.total_height = np.zeros(capacity, dtype=np.float32)
+        self.total_holes = np.zeros(capacity, dtype=np.float32)
+
+        # The column copy of a checkpoint being written, see begin_copy
+        self.column_copy = None
+
+    def __len__(self):
+        return self.size
+
+    def allocate(self, state):
+        shape = (self.capacity,) + np.shape(state)
+        self.states = np.zeros(shape, dtype=state_dtype(state))
+        self.next_states = np.zeros(shape, dtype=state_dtype(state))
+
+    def store(self, state, action, reward, next_state, terminated, bumpiness, total_height, total_holes):
+        if self.states is None:
+            self.allocate(state)
+
+        # When the buffer is full the oldest transition is overwritten
+        i = self.position
+        if self.column_copy is not None:
+            self.keep_overwritten(np.array([i]))
+        self.states[i] = state
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.next_states[i] = next_state
+        self.terminated[i] = terminated
+        self.bumpiness[i] = bumpiness
+        self.total_height[i] = total_height
+        self.total_holes[i] = total_holes
+
+        self.position = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def store_batch(self, states, actions, rewards, next_states, terminated, bumpiness, total_height, total_holes):
+        """Stores a chunk of transitions given as columns and returns the indices they were written to"""
+        if self.states is None:
+            self.allocate(states[0])
+
+        indices = (self.position + np.arange(len(actions))) % self.capacity
+        if self.column_copy is not None:
+            self.keep_overwritten(indices)
+        self.states[indices] = states
+        self.actions[indices] = actions
+        self.rewards[indices] = rewards
+        self.next_states[indices] = next_states
+        self.terminated[indices] = terminated
+        self.bumpiness[indices] = bumpiness
+        self.total_height[indices] = total_height
+        self.total_holes[indices] = total_holes
+
+        self.position = (self.position + len(actions)) % self.capacity
+        self.size = min(self.size + len(actions), self.capacity)
+        return indices
+
+    def sample_indices(self, batch_size):
+        return self.rng.choice(self.size, size=batch_size, replace=False)
+
+    # ============================================================================================#
+    #                                         Checkpoints                                         #
+    # ============================================================================================#
+
+    def snapshot(self):
+        """The counters and the arrays besides the columns, for checkpoints. The columns are copied with
+        copy_columns, or a chunk at a time with begin_copy"""
+        values = {'capacity': self.capacity, 'position': self.position, 'size': self.size,
+                  'rng': self.rng.bit_generator.state}
+        return {}, values
+
+    def copy_columns(self):
+        """Copies of the filled part of every column"""
+        if self.states is None:
+            return {}
+        return {name: getattr(self, name)[:self.size].copy() for name in self.columns}
+
+    def begin_copy(self):
+        """Starts copying the filled part of the columns as they are now and returns the dtype and shape of
+        every column of the copy. A store that overwrites a slot copy_chunk has not reached yet keeps the old
+        row aside first, so the copy is taken a chunk at a time while the buffer keeps filling. The copy
+        methods are called under the same lock as the stores"""
+        if self.column_copy is not None:
+            raise RuntimeError("The columns are already being copied")
+        if self.states is None:
+            return {}
+        self.column_copy = {'position': self.position, 'size': self.size, 'copied': 0, 'overwritten': 0,
+                            'slots': [], 'rows': {name: [] for name in self.columns}}
+        return {name: (getattr(self, name).dtype, (self.size,) + getattr(self, name).shape[1:])
+                for name in self.columns}
+
+    def keep_overwritten(self, indices):
+        # Stores overwrite the slots in ring order from the position of the copy on, offsets counts them
+        copy = self.column_copy
+        offsets = copy['overwritten'] + np.arange(len(indices))
+        copy['overwritten'] = min(copy['overwritten'] + len(indices), self.capacity)
+        keep = (offsets >= copy['copied']) & (offsets < self.capacity) & (indices < copy['size'])
+        if keep.any():
+            slots = indices[keep]
+            copy['slots'].append(slots)
+            for name in self.columns:
+                copy['rows'][name].append(getattr(self, name)[slots].copy())
+
+    def copy_chunk(self, out, start, stop):
+        """Copies the slots from offset start to stop after the position of the copy into the columns in out"""
+        copy = self.column_copy
+        offsets = np.arange(max(start, copy['overwritten']), stop)
+        slots = (copy['position'] + offsets) % self.capacity
+        slots = slots[slots < copy['size']]
+        for name in self.columns:
+            out[name][slots] = getattr(self, name)[slots]
+        copy['copied'] = stop
+
+    def end_copy(self, out=None):
+        """Puts the rows kept aside into out and ends the copy, without out the copy is dropped"""
+        copy, self.column_copy = self.column_copy, None
+        if out is not None and copy is not None:
+            for i, slots in enumerate(copy['slots']):
+                for name in self.columns:
+                    out[name][slots] = copy['rows'][name][i]
+
+    def restore(self, arrays, values):
+        """Loads a snapshot taken from a buffer with the same capacity"""
+        if values['capacity'] != self.capacity:
+            raise ValueError("The snapshot is of a buffer with capacity %d, not %d" % (values['capacity'],
+                                                                                      self.capacity))
+        self.position = values['position']
+        self.size = values['size']
+        self.rng.bit_generator.state = values['rng']
+        if 'states' in arrays:
+            self.allocate(arrays['states'][0])
+            for name in self.columns:
+                getattr(self, name)[:self.size] = arrays[name]
+
+    def get_batch(self, indices):
+        """Returns the columns of the given transitions, in the order DQNAgent.store takes them"""
+        return (self.states[indices], self.actions[indices], self.rewards[indices],
+                self.next_states[indices], self.terminated[indices], self.bumpiness[indices],
+                self.total_height[indices], self.total_holes[indices])
+
+    def sample(self, batch_size):
+        """Returns a uniformly sampled minibatch without replacement"""
+        return self.get_batch(self.sample_indices(batch_size))
+
+    def sample_weighted(self, batch_size):
+        """Returns a minibatch with its indices and importance-sampling weights, None for uniform replay"""
+        indices = self.sample_indices(batch_size)
+        return self.get_batch(indices), indices, None
+
+    def update_priorities(self, indices, td_errors):
+        # Uniform replay has no priorities
+        pass
+
+
+class SumTree:
+    """Binary tree where every parent holds the sum of its two children, the leaves hold the priorities"""
+
+    def __init__(self, capacity):
+        # A power of two number of leaves keeps every leaf at the same depth
+        self.depth = max(int(np.ceil(np.log2(capacity))), 1)
+        self.leaves = 2 ** self.depth
+        self.nodes = np.zeros(2 * self.leaves, dtype=np.float64)
+
+    def total(self):
+        return self.nodes[1]
+
+    def get(self, indices):
+        return self.nodes[indices + self.leaves]
+
+    def update_one(self, index, priority):
+        node = index + self.leaves
+        self.nodes[node] = priority
+        for _ in range(self.depth):
+            node //= 2
+            self.nodes[node] = self.nodes[2 * node] + self.nodes[2 * node + 1]
+
+    def update(self, indices, priorities):
+        nodes = indices + self.leaves
+        self.nodes[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.nodes[nodes] = self.nodes[2 * nodes] + self.nodes[2 * nodes + 1]
+
+    def find(self, values):
+        """Returns the leaf index of every value, walking all values down the tree at once"""
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            go_right = values > self.nodes[left]
+            values = np.where(go_right, values - self.nodes[left], values)
+            nodes = np.where(go_right, left + 1, left)
+        return nodes - self.leaves
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """Replay buffer sampling transitions proportional to their TD error, with a sum-tree index"""
+
+    def __init__(self, capacity, alpha=0.6, beta=0.4, beta_increment=1e-5, epsilon=1e-6, seed=None):
+        ReplayBuffer.__init__(self, capacity, seed)
+        self.tree = SumTree(capacity)
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = beta_increment
+        self.epsilon = epsilon
+        self.max_priority = 1.0
+
+    def store(self, state, action, reward, next_state, terminated, bumpiness, total_height, total_holes):
+        # New transitions get the highest priority so they are sampled at least once
+        self.tree.update_one(self.position, self.max_priority ** self.alpha)
+        ReplayBuffer.store(self, state, action, reward, next_state, terminated, bumpiness, total_height,
+                           total_holes)
+
+    def store_batch(self, states, actions, rewards, next_states, terminated, bumpiness, total_height, total_holes):
+        indices = ReplayBuffer.store_batch(self, states, actions, rewards, next_states, terminated, bumpiness,
+                                           total_height, total_holes)
+        self.tree.update(indices, np.full(len(indices), self.max_priority ** self.alpha))
+        return indices
+
+    def snapshot(self):
+        arrays, values = ReplayBuffer.snapshot(self)
+        arrays['priorities'] = self.tree.nodes.copy()
+        values.update(beta=self.beta, max_priority=self.max_priority)
+        return arrays, values
+
+    def restore(self, arrays, values):
+        ReplayBuffer.restore(self, arrays, values)
+        self.tree.nodes[:] = arrays['priorities']
+        self.beta = values['beta']
+        self.max_priority = values['max_priority']
+
+    def sample_indices(self, batch_size):
+        # One value from each of batch_size equal segments of the total priority
+        segment = self.tree.total() / batch_size
+        values = (np.arange(batch_size) + self.rng.random(batch_size)) * segment
+        return np.minimum(self.tree.find(values), self.size - 1)
+
+    def sample_weighted(self, batch_size):
+        indices = self.sample_indices(batch_size)
+
+        # Importance-sampling weights, normalized so the largest weight is 1
+        probabilities = self.tree.get(indices) / self.tree.total()
+        weights = (self.size * probabilities) ** -self.beta
+        weights /= weights.max()
+        self.beta = min(1.0, self.beta + self.beta_increment)
+
+        return self.get_batch(indices), indices, weights.astype(np.float32)
+
+    def update_priorities(self, indices, td_errors):
+        priorities = np.abs(td_errors) + self.epsilon
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.tree.update(indices, priorities ** self.alpha)
@@ -6,64 +6,124 @@
 # ---------------------------------------------------------------------------- #
 
 from builtins import range
-import numpy as np
+from checkpoint import CheckpointWriter, latest_checkpoint, read_snapshot, restore_snapshot, take_snapshot
 from dqn_agent import DQNAgent
+from dataset import ShardWriter
+from episode_log import EpisodeRecorder
+from evaluate import play_game
+from profiling import Profiler
+import tetris_game
 from tetris_game import TetrisApp
-import time
+from trainer import Trainer
 
 # Configuration
-environment = TetrisApp()
-# If you want to load a saved model: give a model name. Example:
-# agent = DQNAgent('model2_q_network.h5')
-
-agent = DQNAgent('q_network.h5')
+# Set headless to train without a window, otherwise the game is rendered every render_every steps
+headless = False
+render_every = 1
+# What the agent observes: 'position' of the stone, board 'features' or the full 'board'
+obs_mode = 'position'
+# Seed of the stone sequences, None for a new sequence every run
+seed = None
+# Board size and the weights of height, lines, holes and bumpiness in the reward
+board_cols = tetris_game.cols
+board_rows = tetris_game.rows
+reward_weights = tetris_game.reward_weights
+# Every episode is recorded and the best one is saved, replay it with: python episode_log.py best_episode.tlog
+save_best_episode_as = 'best_episode.tlog'
+# If you want to load a saved model: give a model name, None starts from a new model. Example:
+# load_model_from = 'model2_q_network.h5'
+load_model_from = 'q_network.h5'
 save_model_as = 'new_q_network.h5'
 
+# Give a directory to keep every transition on disk for offline training with dataset.py
+log_transitions_to = None
+
 batch_size = 32
 num_of_episodes = 3000
 time_steps_per_episode = 20000  # Amount of allowed actions for each game
-best_episode = [-100, 0, 0.0, 0]  # Reward, Episode, Time, Number of cleared lines
 
+# Training schedule, see trainer.Trainer
+train_every = 1             # Env steps between updates
+gradient_steps = 1          # Minibatches per update
+warmup = None               # Transitions in the replay before training starts, None for the agent's start_size
+target_update_every = None  # Env steps between target updates, None for once per episode
+tau = 1.0                   # Below 1 for soft target updates
+epsilon = None              # Constant or schedule, for example trainer.LinearSchedule(1.0, 0.05, 100000)
+threaded = False            # Train in a learner thread while the environment steps
+max_lag = None              # Updates the learner thread may fall behind, None for no limit
 
-# Function to train a model and save it
-def run_dqn_train():
+# Give a .csv or .jsonl file to time the env and the agent per episode, see profiling.Profiler
+profile_to = None
+profile_export_every = 10
+profile_episodes = None     # (first, last) episode to run cProfile over, saved as training.prof
 
-    for e in range(0, num_of_episodes):
-        # Initialize variables
-        terminated = False
-        episodes_reward = 0
+# Give a directory to save the full training state to every checkpoint_every episodes, in the
+# background. Training pauses only to copy the networks and the counters, the replay is copied by
+# the writer a chunk at a time. With resume the run continues from the newest checkpoint in that directory
+checkpoint_dir = None
+checkpoint_every = 10
+resume = False
 
-        environment.start_game(terminated)
-        state = environment.get_state()
-        state = np.reshape(state, [-1, 1])
 
-        start_timer = time.time()
+def make_environment():
+    environment = TetrisApp(headless=headless, render_every=render_every, obs_mode=obs_mode, seed=seed,
+                            cols=board_cols, rows=board_rows, reward_weights=reward_weights)
+    environment.set_recorder(EpisodeRecorder())
+    return environment
 
-        for time_step in range(time_steps_per_episode):
-            # Run Action
-            environment.reset_reward()
-            action = agent.act(state)
 
-            # Take action
-            next_state, reward, terminated, bumpiness, total_height, total_holes = environment.play(action)
-            next_state = np.reshape(next_state, [-1, 1])
-            agent.store(state, action, reward, next_state, terminated, bumpiness, total_height, total_holes)
-            state = next_state
-            episodes_reward += reward
+def make_agent(action_mode='micro'):
+    if load_model_from is None:
+        agent = DQNAgent(action_mode=action_mode)
+    else:
+        agent = DQNAgent(load_model_from, action_mode=action_mode)
+    if log_transitions_to is not None:
+        agent.transition_log = ShardWriter(log_transitions_to)
+    return agent
 
-            if terminated:
-                agent.align_target_model()
-                break
 
-            #  If we want to quit the ai
-            if environment.quit():
-                break
+def make_profiler():
+    if profile_to is None and profile_episodes is None:
+        return None
+    profiler = Profiler(profile_to, export_every=profile_export_every, profile_episodes=profile_episodes)
+    profiler.enable()
+    return profiler
 
-            if len(agent.experience_replay) > batch_size:
-                agent.retrain(batch_size)
 
-        end_timer = time.time()
-        total_time = end_timer - start_timer
+def make_trainer(environment, agent):
+    return Trainer(environment, agent, batch_size=batch_size, train_every=train_every,
+                   gradient_steps=gradient_steps, warmup=warmup, target_update_every=target_update_every, tau=tau,
+                   epsilon=epsilon, threaded=threaded, max_lag=max_lag)
+
+
+# Function to train a model and save it
+def run_dqn_train(environment, agent):
+    trainer = make_trainer(environment, agent)
+    profiler = make_profiler()
+    best_episode = [-100, 0, 0.0, 0]  # Reward, Episode, Time, Number of cleared lines
+
+    checkpoints = None
+    first_episode = 0
+    if checkpoint_dir is not None:
+        checkpoints = CheckpointWriter(checkpoint_dir)
+        latest = latest_checkpoint(checkpoint_dir) if resume else None
+        if latest is not None:
+            extra = restore_snapshot(read_snapshot(latest), agent, trainer, environment)
+            first_episode = extra['episode'] + 1
+            best_episode = extra['best_episode']
+            print("Resumed from: ", latest, "at episode: ", first_episode)
+
+    for e in range(first_episode, num_of_episodes):
+        if profiler is not None:
+            profiler.start_episode(e)
+        env_steps, updates = trainer.env_steps, trainer.updates
+        episodes_reward, total_time = trainer.run_episode(time_steps_per_episode)
+        if profiler is not None:
+            profiler.count('env.steps', trainer.env_steps - env_steps)
+            profiler.count('env.pieces', environment.get_number_of_pieces())
+            profiler.count('env.lines', environment.get_number_of_lines())
+            profiler.count('trainer.updates', trainer.updates - updates)
+            profiler.end_episode(e)
 
         # Get the highest reward
         if episodes_reward > best_episode[0]:
@@ -71,6 +131,8 @@ def run_dqn_train():
             best_episode[1] = e
             best_episode[2] = total_time
             best_episode[3] = environment.get_number_of_lines()
+            if environment.recorder is not None:
+                environment.recorder.save(save_best_episode_as)
 
         print("**********************************")
         print("Episode/Game: ", e)
@@ -79,10 +141,21 @@ def run_dqn_train():
         print("Total cleared lines: ", environment.get_number_of_lines())
         print("**********************************")
 
+        if checkpoints is not None and (e + 1) % checkpoint_every == 0:
+            checkpoints.wait()
+            snapshot = take_snapshot(agent, trainer, environment, {'episode': e, 'best_episode': list(best_episode)})
+            checkpoints.save(snapshot, trainer.env_steps)
+
         # Check if we didn't quit the ai with QUIT
         if environment.quit():
             break
 
+    trainer.stop()
+    if checkpoints is not None:
+        checkpoints.wait()
+    if profiler is not None:
+        profiler.export()
+        profiler.disable()
     print("______________________________________")
     print("The highest reward was: ", best_episode[0], "in game: ", best_episode[1])
     print("With the time: ", best_episode[2], "Seconds")
@@ -90,13 +163,41 @@ def run_dqn_train():
     print("______________________________________")
     agent.q_network.summary()
     agent.save_model(save_model_as)
+    if agent.transition_log is not None:
+        agent.transition_log.flush()
+
+
+# Function to train an agent in placement mode, it picks the final position of every stone
+def run_dqn_placement_train(environment, placement_agent):
+    trainer = make_trainer(environment, placement_agent)
+
+    for e in range(0, num_of_episodes):
+        episodes_reward, total_time = trainer.run_episode(time_steps_per_episode)
+
+        print("**********************************")
+        print("Episode/Game: ", e)
+        print("Total time: ", total_time, "Seconds")
+        print("Episodes total reward: ", episodes_reward)
+        print("Total cleared lines: ", environment.get_number_of_lines())
+        print("**********************************")
+
+        if environment.quit():
+            break
+
+    trainer.stop()
+    placement_agent.save_model(save_model_as)
 
 
-# Function to play the game with a loaded model
-"""def run_dqn():
-    # Load the model you want to play with
-    # loaded_agent = load_model()"""
+# Function to play the game with a loaded model, without exploring or training.
+# To score a model over many games use: python evaluate.py q_network.h5
+def run_dqn(environment, agent):
+    agent.epsilon = 0.0
+    for e in range(0, num_of_episodes):
+        lines, pieces, episodes_reward, steps = play_game(environment, agent, None, time_steps_per_episode)
+        print("Episode/Game: ", e, "Reward: ", episodes_reward, "Cleared lines: ", lines, "Pieces: ", pieces)
+        if environment.quit():
+            break
 
 
 if __name__ == '__main__':
-    run_dqn_train()
+    run_dqn_train(make_environment(), make_agent())
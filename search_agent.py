@@ -0,0 +1,320 @@
+# =============================================================================#
+# Name        : search_agent.py                                                #
+# Description : Lookahead search player using the current and next stone       #
+# ---------------------------------------------------------------------------- #
+# Every search level places one stone on a batch of boards at once with       #
+# NumPy: the reachable final positions of the stone are found for all boards,  #
+# the stones are seated and full rows removed. The first two levels use the    #
+# current and the next stone, deeper levels average over all seven stones.    #
+# Leaf boards are scored with the get_reward heuristic or a placement network, #
+# the network scores are cached per board.                                     #
+# =============================================================================#
+
+import argparse
+import functools
+import time
+
+import numpy as np
+
+from tetris_game import TetrisApp, tetris_shapes, build_piece_rotations, reward_weights, cols, rows
+from vec_tetris import build_piece_tables, piece_cell_y
+
+# Score of a board where the next stone can not be placed
+game_over_score = -1e9
+
+
+# ================================================================================================#
+#                                      Placement Tables                                          #
+# ================================================================================================#
+
+# Every distinct rotation of every piece at every column it fits in, flattened, with the range of
+# each piece given by placement_start and placement_count. Rotations with the same shape as an
+# earlier one give the same boards and are left out. Built once per board width
+@functools.lru_cache(maxsize=None)
+def build_placement_tables(cols=cols):
+    rotations, xs, start, count = [], [], [], []
+    for piece in build_piece_rotations(cols):
+        start.append(len(rotations))
+        seen_shapes = set()
+        for rotation, entry in enumerate(piece):
+            if entry.shape not in seen_shapes:
+                seen_shapes.add(entry.shape)
+                for x in range(cols - entry.width + 1):
+                    rotations.append(rotation)
+                    xs.append(x)
+        count.append(len(rotations) - start[-1])
+    return np.array(rotations), np.array(xs), np.array(start), np.array(count)
+
+
+# Rows any rotation of a stone covers at the spawn position
+spawn_rows = int(piece_cell_y.max()) + 1
+
+
+# ================================================================================================#
+#                                       Batched Placement                                        #
+# ================================================================================================#
+
+def reachable_positions(boards, pieces):
+    """(boards, 4, cols) mask of the positions a stone reaches by rotating at the spawn position and then
+    moving sideways along the top row, the same positions TetrisApp.get_placements enumerates"""
+    n, rows, cols = boards.shape
+    index = np.arange(n)
+    x = np.arange(cols)
+    piece_cell_x, piece_cell_y, piece_width, piece_spawn_x = build_piece_tables(cols)
+
+    # Whether each rotation of the stone fits at each column of the top row
+    cx = x[None, None, :, None] + piece_cell_x[pieces][:, :, None, :]
+    cy = np.broadcast_to(piece_cell_y[pieces][:, :, None, :], cx.shape)
+    inside = x[None, None, :] <= cols - piece_width[pieces][:, :, None]
+    free = inside & ~boards[index[:, None, None, None], cy, np.minimum(cx, cols - 1)].any(axis=3)
+
+    # A rotation is reachable if it and every rotation before it fit at the spawn column
+    start = piece_spawn_x[pieces][:, None, None]
+    turned = np.logical_and.accumulate(np.take_along_axis(free, start, axis=2), axis=1)
+
+    # A column is reachable if nothing is in the way between it and the spawn column, counted with
+    # the running number of blocked columns
+    blocked = np.zeros((n, 4, cols + 1), dtype=np.int64)
+    np.cumsum(~free, axis=2, out=blocked[:, :, 1:])
+    low = np.minimum(start, x[None, None, :])
+    high = np.maximum(start, x[None, None, :]) + 1
+    low = np.broadcast_to(low, free.shape)
+    high = np.broadcast_to(high, free.shape)
+    in_the_way = np.take_along_axis(blocked, high, axis=2) - np.take_along_axis(blocked, low, axis=2)
+    return turned & (in_the_way == 0)
+
+
+def place_pieces(boards, pieces):
+    """Seats every reachable placement of pieces[i] on boards[i]. Returns the new boards, the index of
+    the board each came from, the rotation and column of the placement and the number of cleared rows"""
+    rows, cols = boards.shape[1:]
+    piece_cell_x, piece_cell_y = build_piece_tables(cols)[:2]
+    placement_rotation, placement_x, placement_start, placement_count = build_placement_tables(cols)
+
+    # All placements of every board's piece
+    counts = placement_count[pieces]
+    parent = np.repeat(np.arange(len(boards)), counts)
+    candidate = placement_start[pieces][parent] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                                                      counts)
+    rotation = placement_rotation[candidate]
+    x = placement_x[candidate]
+
+    # Stones only get in each other's way in the rows a stone spawns in, so the reachable
+    # positions are only worked out for boards with something in those rows
+    crowded = np.flatnonzero(boards[:, :spawn_rows].any(axis=(1, 2)))
+    if len(crowded):
+        reachable = np.ones((len(boards), 4, cols), dtype=bool)
+        reachable[crowded] = reachable_positions(boards[crowded], pieces[crowded])
+        keep = reachable[parent, rotation, x]
+        parent, rotation, x = parent[keep], rotation[keep], x[keep]
+    piece = pieces[parent]
+
+    # The stone drops straight down from the top row until a cell lands on a filled cell. A cell can
+    # start below the top of its column, so it lands on the first filled cell below where it starts
+    below = np.where(boards, np.arange(rows)[None, :, None], rows)
+    below = np.minimum.accumulate(below[:, ::-1], axis=1)[:, ::-1]
+    cx = x[:, None] + piece_cell_x[piece, rotation]
+    cy = piece_cell_y[piece, rotation]
+    off_y = (below[parent[:, None], cy, cx] - cy).min(axis=1) - 1
+
+    children = boards[parent]
+    children[np.arange(len(parent))[:, None], off_y[:, None] + cy, cx] = True
+
+    # A stable sort moves the full rows to the top and keeps the order of the others, like VecTetris
+    full = children.all(axis=2)
+    cleared = full.sum(axis=1)
+    if cleared.any():
+        order = np.argsort(~full, axis=1, kind='stable')
+        children = children[np.arange(len(children))[:, None], order]
+        children[np.arange(rows)[None, :] < cleared[:, None]] = False
+    return children, parent, rotation, x, cleared
+
+
+def board_features(boards):
+    """Holes, bumpiness and aggregated height of every board, the same measures as TetrisApp"""
+    filled = boards.any(axis=1)
+    heights = np.where(filled, boards.shape[1] - boards.argmax(axis=1), 0)
+    bumpiness = np.abs(np.diff(heights, axis=1)).sum(axis=1)
+    # The floor below the board is filled, so the bottom row has no holes of its own
+    holes = (boards[:, :-1] & ~boards[:, 1:]).sum(axis=(1, 2))
+    return holes, bumpiness, heights.sum(axis=1)
+
+
+# ================================================================================================#
+#                                        Search Agent                                            #
+# ================================================================================================#
+
+class SearchAgent(object):
+    """Picks placements by searching over the current and next stone. depth is the number of stones
+    placed, beyond the two known ones every stone is tried. With beam_width only that many boards,
+    plus the best one per stone, are expanded at each level. agent is a DQNAgent in placement mode to
+    score leaves with, None scores them with weights like TetrisApp.get_reward. Without weights play
+    uses the reward weights of the environment it plays and search the default ones"""
+
+    def __init__(self, depth=2, beam_width=None, agent=None, weights=None, cache_size=200000):
+        if depth < 1:
+            raise ValueError("The search depth must be at least 1")
+        if agent is not None and agent.action_mode != 'placement':
+            raise ValueError("Leaves are scored with a placement agent")
+        self.depth = depth
+        self.beam_width = beam_width
+        self.agent = agent
+        self.weights = weights
+        self.cache_size = cache_size
+        self.cache = {}
+        self.cache_hits = 0
+        self.evaluations = 0
+
+    def score(self, boards, lines, weights=None):
+        """Scores boards reached with `lines` cleared rows on the way"""
+        if self.agent is None:
+            # The heuristic is cheaper to compute for a whole batch than looking boards up one by one
+            holes, bumpiness, height = board_features(boards)
+            if weights is None:
+                weights = reward_weights if self.weights is None else self.weights
+            a, b, c, d = weights
+            self.evaluations += len(boards)
+            return a * height + b * lines + c * holes + d * bumpiness
+        return self.score_cached(boards, lines)
+
+    def score_cached(self, boards, lines):
+        """Scores boards with the agent's network, looking each one up in the cache first"""
+        packed = np.packbits(boards.reshape(len(boards), -1), axis=1)
+        keys = np.concatenate((packed, lines.astype(np.uint8)[:, None]), axis=1)
+        keys = keys.view('V%d' % keys.shape[1]).ravel().tolist()
+
+        scores = np.empty(len(boards))
+        missing = []
+        cache = self.cache
+        for i, key in enumerate(keys):
+            cached = cache.get(key)
+            if cached is None:
+                missing.append(i)
+            else:
+                scores[i] = cached
+        self.cache_hits += len(keys) - len(missing)
+        if not missing:
+            return scores
+
+        missing = np.array(missing)
+        holes, bumpiness, height = board_features(boards[missing])
+        features = np.stack((lines[missing], holes, bumpiness, height), axis=1).astype(np.float32)
+        new_scores = self.agent.q_values(features)[:, 0]
+        scores[missing] = new_scores
+        self.evaluations += len(missing)
+
+        if len(cache) + len(missing) > self.cache_size:
+            cache.clear()
+        cache.update(zip((keys[i] for i in missing), new_scores.tolist()))
+        return scores
+
+    def prune(self, scores, groups):
+        """Mask of the boards to expand, the beam_width best ones and the best one of every group"""
+        keep = np.zeros(len(scores), dtype=bool)
+        keep[np.argsort(-scores)[:self.beam_width]] = True
+        best = np.full(groups.max() + 1, -np.inf)
+        np.maximum.at(best, groups, scores)
+        return keep | (scores == best[groups])
+
+    def search(self, board, piece, next_piece, weights=None):
+        """Returns the rotations, columns and searched values of the placements of piece on board,
+        board being a (rows, cols) array of the filled cells. weights replaces the agent's own"""
+        boards = np.asarray(board, dtype=bool)[None]
+        lines = np.zeros(1, dtype=np.int64)
+        levels = []
+
+        for level in range(self.depth):
+            # The two known stones, then every stone for each board
+            unknown = level >= 2
+            if level == 0:
+                pieces = np.array([piece])
+            elif level == 1:
+                pieces = np.full(len(boards), next_piece)
+            else:
+                pieces = np.tile(np.arange(len(tetris_shapes)), len(boards))
+                boards = np.repeat(boards, len(tetris_shapes), axis=0)
+                lines = np.repeat(lines, len(tetris_shapes))
+
+            children, parent, rotation, x, cleared = place_pieces(boards, pieces)
+            levels.append({'boards': len(boards), 'unknown': unknown, 'parent': parent,
+                           'rotation': rotation, 'x': x, 'expand': None})
+            boards, lines = children, lines[parent] + cleared
+            if not len(boards) or level == self.depth - 1:
+                break
+
+            if self.beam_width is not None:
+                scores = self.score(boards, lines, weights)
+                expand = self.prune(scores, parent)
+                levels[-1]['expand'] = expand
+                boards, lines = boards[expand], lines[expand]
+
+        # Back the leaf scores up the levels: the best placement per stone, the mean over unknown stones.
+        # Boards left out of the beam are never picked
+        values = self.score(boards, lines, weights) if len(boards) else np.zeros(0)
+        for depth in reversed(range(1, len(levels))):
+            level = levels[depth]
+            best = np.full(level['boards'], game_over_score)
+            np.maximum.at(best, level['parent'], values)
+            if level['unknown']:
+                best = best.reshape(-1, len(tetris_shapes)).mean(axis=1)
+            values = best
+
+            above = levels[depth - 1]
+            if above['expand'] is not None:
+                values = np.full(len(above['expand']), -np.inf)
+                values[above['expand']] = best
+        return levels[0]['rotation'], levels[0]['x'], values
+
+    def choose(self, board, piece, next_piece, weights=None):
+        """Returns the (rotation, x) of the best placement, or None if the stone can not be placed"""
+        rotation, x, values = self.search(board, piece, next_piece, weights)
+        if not len(values):
+            return None
+        best = int(np.argmax(values))
+        return int(rotation[best]), int(x[best])
+
+    def play(self, environment):
+        """Plays the best placement of the current stone of environment, returns the same tuple as play"""
+        board = np.array(environment.board[:environment.rows], dtype=bool)
+        weights = environment.reward_weights if self.weights is None else self.weights
+        placement = self.choose(board, environment.stone_id, environment.next_stone_id, weights)
+        if placement is None:
+            # Nothing fits, the stone is dropped where it is and ends the game
+            placement = (0, environment.stone_x)
+        return environment.play_placement(*placement)
+
+
+# Plays games with the search agent and reports the speed
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Play Tetris with the lookahead search agent')
+    parser.add_argument('--pieces', type=int, default=10000, help='Stones to place in total')
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--beam-width', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cols', type=int, default=cols)
+    parser.add_argument('--rows', type=int, default=rows)
+    parser.add_argument('--reward-weights', type=float, nargs=4, default=reward_weights,
+                        help='Weights of height, lines, holes and bumpiness')
+    args = parser.parse_args()
+
+    environment = TetrisApp(headless=True, engine='bitboard', seed=args.seed, cols=args.cols, rows=args.rows,
+                            reward_weights=args.reward_weights)
+    search_agent = SearchAgent(args.depth, args.beam_width)
+    games = 0
+    lines_per_game = []
+    start_timer = time.time()
+    for _ in range(args.pieces):
+        terminated = search_agent.play(environment)[2]
+        if terminated:
+            games += 1
+            lines_per_game.append(environment.get_number_of_lines())
+            environment.start_game(False)
+    total_time = time.time() - start_timer
+
+    print("______________________________________")
+    print("Pieces per second: ", args.pieces / total_time)
+    print("Finished games: ", games, "Lines in the current game: ", environment.get_number_of_lines())
+    if lines_per_game:
+        print("Mean lines per finished game: ", np.mean(lines_per_game))
+    print("Cache hits: ", search_agent.cache_hits, "Evaluations: ", search_agent.evaluations)
+    print("______________________________________")
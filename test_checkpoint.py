@@ -0,0 +1,100 @@
+# =============================================================================#
+# Name        : test_checkpoint.py                                             #
+# Description : Checks of the checkpoints, run with: python -m pytest          #
+# ---------------------------------------------------------------------------- #
+# The replay columns of a checkpoint are copied a chunk at a time while the    #
+# buffer keeps filling, the copy has to hold the buffer as it was when the     #
+# snapshot was taken. A run resumed from a checkpoint has to train exactly     #
+# like the run that went on after saving it.                                   #
+# =============================================================================#
+
+import importlib.util
+import random
+
+import numpy as np
+import pytest
+
+import checkpoint
+from checkpoint import CheckpointWriter, latest_checkpoint, read_snapshot, restore_snapshot, take_snapshot
+from dqn_agent import DQNAgent
+from replay_buffer import ReplayBuffer, PrioritizedReplayBuffer
+from tetris_game import TetrisApp
+from trainer import Trainer
+
+buffers = [ReplayBuffer, PrioritizedReplayBuffer]
+backends = ['numpy', pytest.param('keras', marks=pytest.mark.skipif(importlib.util.find_spec('keras') is None,
+                                                                   reason='Keras is not installed'))]
+
+
+def store_random(replay, rng, n):
+    # Single stores and batches of random size, so the stores wrap around the buffer at any slot
+    for _ in range(n):
+        if rng.random() < 0.5:
+            replay.store(rng.normal(size=(2, 1)).astype(np.float32), rng.integers(5), rng.random(),
+                         rng.normal(size=(2, 1)).astype(np.float32), False, 1, 2, 3)
+        else:
+            k = int(rng.integers(1, 40))
+            replay.store_batch(rng.normal(size=(k, 2, 1)).astype(np.float32), rng.integers(5, size=k),
+                               rng.random(k), rng.normal(size=(k, 2, 1)).astype(np.float32), np.zeros(k, dtype=bool),
+                               np.ones(k), np.ones(k), np.ones(k))
+
+
+@pytest.mark.parametrize('buffer', buffers)
+@pytest.mark.parametrize('seed', range(20))
+def test_chunked_copy_matches_copy_columns(buffer, seed):
+    rng = np.random.default_rng(seed)
+    replay = buffer(500)
+    store_random(replay, rng, int(rng.integers(1, 60)))
+    expected = replay.copy_columns()
+
+    layout = replay.begin_copy()
+    out = {name: np.zeros(shape, dtype=dtype) for name, (dtype, shape) in layout.items()}
+    for start in range(0, replay.capacity, 37):
+        replay.copy_chunk(out, start, min(start + 37, replay.capacity))
+        store_random(replay, rng, int(rng.integers(0, 8)))
+    replay.end_copy(out)
+
+    assert replay.column_copy is None
+    for name in expected:
+        assert np.array_equal(out[name], expected[name])
+
+
+def make_run(backend, prioritized):
+    environment = TetrisApp(headless=True, seed=11)
+    agent = DQNAgent(memory_size=64, prioritized=prioritized, backend=backend)
+    trainer = Trainer(environment, agent, batch_size=16, warmup=50, target_update_every=100)
+    return environment, agent, trainer
+
+
+def train(trainer, episodes):
+    for _ in range(episodes):
+        trainer.run_episode(200)
+
+
+@pytest.mark.parametrize('backend', backends)
+@pytest.mark.parametrize('prioritized', [False, True])
+def test_resume_matches_uninterrupted_run(tmp_path, monkeypatch, backend, prioritized):
+    # Small chunks and a small buffer, so the run overwrites slots the writer has not copied yet
+    monkeypatch.setattr(checkpoint, 'replay_chunk', 8)
+    np.random.seed(0)
+    random.seed(0)
+
+    environment, agent, trainer = make_run(backend, prioritized)
+    train(trainer, 3)
+    checkpoints = CheckpointWriter(str(tmp_path))
+    checkpoints.save(take_snapshot(agent, trainer, environment, {'episode': 2}), trainer.env_steps)
+    train(trainer, 3)
+    checkpoints.wait()
+
+    environment_resumed, agent_resumed, trainer_resumed = make_run(backend, prioritized)
+    extra = restore_snapshot(read_snapshot(latest_checkpoint(str(tmp_path))), agent_resumed, trainer_resumed,
+                             environment_resumed)
+    assert extra == {'episode': 2}
+    train(trainer_resumed, 3)
+
+    assert trainer_resumed.env_steps == trainer.env_steps
+    assert trainer_resumed.updates == trainer.updates
+    for weights, resumed in zip(agent.q_network.get_weights(), agent_resumed.q_network.get_weights()):
+        assert np.array_equal(weights, resumed)
+    for name, column in agent.experience_replay.copy_columns().items():
+        assert np.array_equal(column, agent_resumed.experience_replay.copy_columns()[name])
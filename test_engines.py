@@ -0,0 +1,130 @@
+# =============================================================================#
+# Name        : test_engines.py                                                #
+# Description : Cross-checks of the game engines, run with: python -m pytest   #
+# ---------------------------------------------------------------------------- #
+# The list and bitboard engines of TetrisApp, the batched VecTetris, the       #
+# placements of get_placements and the batched placements of the search agent  #
+# all play by the same rules. Every check plays seeded random games, on the    #
+# default board and on other sizes, and compares the engines step by step.    #
+# =============================================================================#
+
+import random
+
+import numpy as np
+import pytest
+
+from search_agent import place_pieces, board_features
+from tetris_game import TetrisApp, bitboard_from_board, board_tables, cols, rows
+from vec_tetris import VecTetris
+
+sizes = [(cols, rows), (10, 20), (8, 16)]
+
+
+@pytest.mark.parametrize('size', sizes)
+@pytest.mark.parametrize('obs_mode', ['position', 'features', 'board'])
+def test_bitboard_engine_plays_like_list_engine(size, obs_mode):
+    environments = [TetrisApp(headless=True, engine=engine, obs_mode=obs_mode, seed=5, cols=size[0], rows=size[1])
+                    for engine in ('list', 'bitboard')]
+    rng = random.Random(1)
+    lines = 0
+
+    # Single moves alternate with whole placements, random moves alone hardly clear rows on big boards
+    for step in range(3000):
+        if step % 2:
+            placements = [environment.get_placements() for environment in environments]
+            assert placements[0] == placements[1]
+            if not placements[0]:
+                continue
+            rotation, x = placements[0][rng.randrange(len(placements[0]))][:2]
+            outputs = [environment.play_placement(rotation, x) for environment in environments]
+        else:
+            action = rng.randrange(5)
+            outputs = [environment.play(action) for environment in environments]
+        assert np.array_equal(outputs[0][0], outputs[1][0])
+        assert outputs[0][1:] == outputs[1][1:]
+
+        list_app, bitboard_app = environments
+        assert list_app.board == bitboard_app.board
+        assert np.array_equal(list_app.get_board_view(), bitboard_app.get_board_view())
+        assert bitboard_app.bitboard == bitboard_from_board(bitboard_app.board)
+        assert list_app.get_stone() == bitboard_app.get_stone()
+
+        if outputs[0][2]:
+            lines += list_app.get_number_of_lines()
+            for environment in environments:
+                environment.start_game(False)
+    assert lines > 0
+
+
+@pytest.mark.parametrize('size', sizes)
+def test_vec_tetris_plays_like_tetris_app(size):
+    environment = TetrisApp(headless=True, cols=size[0], rows=size[1])
+    vec = VecTetris(1, seed=3, cols=size[0], rows=size[1])
+    environment.start_game(False, seed=int(vec.episode_seeds[0]))
+    rng = random.Random(2)
+    games = 0
+
+    for step in range(3000):
+        action = rng.randrange(5)
+        states, rewards, terminated, bumpiness, height, holes = vec.step([action])
+        output = environment.play(action)
+        assert rewards[0] == pytest.approx(output[1])
+        assert (terminated[0], bumpiness[0], height[0], holes[0]) == tuple(output[2:])
+
+        if output[2]:
+            games += 1
+            # The finished board is reset with a new seed, the app follows it
+            environment.start_game(False, seed=int(vec.episode_seeds[0]))
+        else:
+            assert np.array_equal(vec.boards[0], np.array(environment.board))
+            assert np.array_equal(states[0], environment.observe())
+    assert games > 0
+
+
+@pytest.mark.parametrize('size', sizes)
+@pytest.mark.parametrize('engine', ['list', 'bitboard'])
+def test_placement_features_match_play_placement(size, engine):
+    environment = TetrisApp(headless=True, engine=engine, seed=7, cols=size[0], rows=size[1])
+    rng = random.Random(3)
+    cleared = 0
+
+    for step in range(2000):
+        placements = environment.get_placements()
+        if not placements:
+            environment.start_game(False)
+            continue
+        rotation, x, features = placements[rng.randrange(len(placements))]
+        state, reward, terminated = environment.play_placement(rotation, x)[:3]
+        assert tuple(state) == features
+        cleared += features[0]
+        if terminated:
+            environment.start_game(False)
+    assert cleared > 0
+
+
+@pytest.mark.parametrize('size', sizes)
+def test_place_pieces_matches_get_placements(size):
+    environment = TetrisApp(headless=True, engine='bitboard', seed=9, cols=size[0], rows=size[1])
+    piece_rotations = board_tables(*size).piece_rotations
+    rng = random.Random(4)
+
+    for step in range(1000):
+        placements = environment.get_placements()
+        board = np.array(environment.board[:environment.rows], dtype=bool)
+        children, parent, rotation, x, cleared = place_pieces(board[None], np.array([environment.stone_id]))
+        holes, bumpiness, height = board_features(children)
+
+        # Rotations with the same shape give the same placements, they are compared by shape
+        searched = {(piece_rotations[environment.stone_id][r].shape, int(column)):
+                    (int(lines), int(h), int(b), int(a))
+                    for r, column, lines, h, b, a in zip(rotation, x, cleared, holes, bumpiness, height)}
+        expected = {(piece_rotations[environment.stone_id][(environment.stone_rotation + r) % 4].shape, column):
+                    features for r, column, features in placements}
+        assert searched == expected
+
+        if not placements:
+            environment.start_game(False)
+            continue
+        r, column = placements[rng.randrange(len(placements))][:2]
+        if environment.play_placement(r, column)[2]:
+            environment.start_game(False)
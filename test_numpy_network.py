@@ -0,0 +1,73 @@
+# =============================================================================#
+# Name        : test_numpy_network.py                                          #
+# Description : Checks of the NumPy backend, run with: python -m pytest        #
+# ---------------------------------------------------------------------------- #
+# The NumPy network has to train like the Keras model it replaces, Adam on the #
+# weighted mean squared error, and read the .h5 files Keras writes. The checks #
+# against Keras are skipped when Keras is not installed.                       #
+# =============================================================================#
+
+import numpy as np
+import pytest
+
+import numpy_network
+from numpy_network import NumpyNetwork
+
+
+def keras_model(units, activations, input_dim):
+    keras = pytest.importorskip('keras')
+    model = keras.Sequential([keras.layers.Dense(n, activation=activation)
+                              for n, activation in zip(units, activations)])
+    model.compile(loss='mse', optimizer=keras.optimizers.Adam(learning_rate=0.001))
+    model.predict_on_batch(np.zeros((1, input_dim), dtype=np.float32))
+    return model
+
+
+def test_save_weights_round_trip(tmp_path):
+    network = NumpyNetwork([8, 3], ['relu', 'linear'], seed=0)
+    network.build(4)
+    path = str(tmp_path / 'network.npz')
+    network.save(path)
+
+    loaded = NumpyNetwork.load(path)
+    assert numpy_network.is_numpy_export(path)
+    assert loaded.activations == ['relu', 'linear']
+    for weights, saved in zip(network.get_weights(), loaded.get_weights()):
+        assert np.array_equal(weights, saved)
+
+
+@pytest.mark.parametrize('weighted', [False, True])
+def test_adam_and_weighted_mse_match_keras(weighted):
+    units, activations = [32, 32, 5], ['relu', 'relu', 'linear']
+    model = keras_model(units, activations, 2)
+    network = NumpyNetwork(units, activations)
+    network.set_weights(model.get_weights())
+
+    rng = np.random.default_rng(0)
+    for _ in range(5):
+        inputs = rng.normal(size=(16, 2)).astype(np.float32)
+        targets = rng.normal(size=(16, 5)).astype(np.float32)
+        sample_weight = rng.random(16).astype(np.float32) if weighted else None
+        keras_loss = float(np.asarray(model.train_on_batch(inputs, targets, sample_weight=sample_weight)))
+        loss = network.train_on_batch(inputs, targets, sample_weight=sample_weight)
+        assert loss == pytest.approx(keras_loss, rel=1e-4)
+
+    for keras_weights, weights in zip(model.get_weights(), network.get_weights()):
+        assert np.allclose(keras_weights, weights, atol=1e-6)
+
+
+def test_load_weights_reads_keras_h5(tmp_path):
+    units, activations = [32, 32, 5], ['relu', 'relu', 'linear']
+    model = keras_model(units, activations, 2)
+    pytest.importorskip('h5py')
+    path = str(tmp_path / 'model.h5')
+    model.save(path)
+
+    weights, loaded_activations = numpy_network.load_weights(path)
+    assert not numpy_network.is_numpy_export(path)
+    assert loaded_activations == activations
+    for keras_weights, loaded in zip(model.get_weights(), weights):
+        assert np.array_equal(keras_weights, loaded)
+
+    inputs = np.random.default_rng(1).normal(size=(4, 2)).astype(np.float32)
+    assert np.allclose(NumpyNetwork.load(path).predict_on_batch(inputs), model.predict_on_batch(inputs), atol=1e-6)
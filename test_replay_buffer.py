@@ -0,0 +1,94 @@
+# =============================================================================#
+# Name        : test_replay_buffer.py                                          #
+# Description : Checks of the prioritized replay, run with: python -m pytest   #
+# ---------------------------------------------------------------------------- #
+# The sum tree has to keep every parent the sum of its children and find the   #
+# leaves in proportion to their priorities. The prioritized buffer gives new   #
+# transitions the highest priority seen so far and normalizes the importance- #
+# sampling weights so the largest one is 1.                                    #
+# =============================================================================#
+
+import numpy as np
+import pytest
+
+from replay_buffer import SumTree, PrioritizedReplayBuffer
+
+
+def assert_sums(tree):
+    # Every parent holds the sum of its two children
+    parents = np.arange(1, tree.leaves)
+    assert np.allclose(tree.nodes[parents], tree.nodes[2 * parents] + tree.nodes[2 * parents + 1])
+
+
+def store_transitions(replay, n, rng):
+    replay.store_batch(rng.normal(size=(n, 2, 1)).astype(np.float32), rng.integers(5, size=n), rng.random(n),
+                       rng.normal(size=(n, 2, 1)).astype(np.float32), np.zeros(n, dtype=bool), np.ones(n),
+                       np.ones(n), np.ones(n))
+
+
+@pytest.mark.parametrize('capacity', [1, 5, 8, 100])
+def test_find_returns_leaves_in_proportion_to_their_priorities(capacity):
+    tree = SumTree(capacity)
+    priorities = np.random.default_rng(0).random(capacity) + 0.1
+    tree.update(np.arange(capacity), priorities)
+    assert_sums(tree)
+    assert tree.total() == pytest.approx(priorities.sum())
+
+    # Evenly spread values hit every leaf as often as its share of the total
+    draws = 100000
+    values = (np.arange(draws) + 0.5) / draws * tree.total()
+    counts = np.bincount(tree.find(values), minlength=tree.leaves)
+    assert not counts[capacity:].any()
+    assert np.all(np.abs(counts[:capacity] - priorities / priorities.sum() * draws) <= 1)
+
+
+def test_update_with_repeated_indices():
+    tree = SumTree(10)
+    tree.update(np.arange(10), np.ones(10))
+    rng = np.random.default_rng(1)
+    for _ in range(100):
+        indices = rng.integers(10, size=16)
+        priorities = rng.random(16)
+        tree.update(indices, priorities)
+
+        # A repeated index keeps the last of its priorities, like a loop of update_one calls
+        expected = SumTree(10)
+        expected.nodes[:] = tree.nodes
+        for index, priority in zip(indices, priorities):
+            expected.update_one(index, priority)
+        assert np.allclose(tree.nodes, expected.nodes)
+        assert_sums(tree)
+
+
+def test_importance_sampling_weights_are_normalized():
+    rng = np.random.default_rng(2)
+    replay = PrioritizedReplayBuffer(64, beta=0.5, beta_increment=0.0, seed=3)
+    store_transitions(replay, 50, rng)
+    replay.update_priorities(np.arange(50), rng.normal(size=50))
+
+    batch, indices, weights = replay.sample_weighted(32)
+    probabilities = replay.tree.get(indices) / replay.tree.total()
+    expected = (replay.size * probabilities) ** -replay.beta
+    assert weights.max() == pytest.approx(1.0)
+    assert np.allclose(weights, expected / expected.max())
+    # The least likely transition of the batch has the largest weight
+    assert weights[np.argmin(probabilities)] == pytest.approx(1.0)
+
+
+def test_store_batch_gives_the_highest_priority():
+    rng = np.random.default_rng(4)
+    replay = PrioritizedReplayBuffer(20, alpha=0.6)
+    store_transitions(replay, 15, rng)
+    assert np.allclose(replay.tree.get(np.arange(15)), 1.0)
+
+    replay.update_priorities(np.arange(15), np.linspace(0.0, 3.0, 15))
+    max_priority = 3.0 + replay.epsilon
+    assert replay.max_priority == pytest.approx(max_priority)
+
+    # The batch wraps around the end of the buffer and overwrites the oldest slots
+    store_transitions(replay, 10, rng)
+    stored = (15 + np.arange(10)) % 20
+    assert np.allclose(replay.tree.get(stored), max_priority ** replay.alpha)
+    assert np.allclose(replay.tree.get(np.arange(5, 15)),
+                       (np.linspace(0.0, 3.0, 15)[5:] + replay.epsilon) ** replay.alpha)
+    assert_sums(replay.tree)
@@ -8,20 +8,24 @@
 # Author      : Ronja Faltin, Johanna Granström, Emilie Ho                     #
 # =============================================================================#
 
-from random import randrange as rand
+import collections
+import functools
+import random
 
 import pygame
 import numpy as np
 
-# The configuration
+# The configuration, cols and rows are the default board size of a TetrisApp
 cell_size = 30
 cell_size_inner = 25
 cols = 6
 rows = 12
-max_fps = 60
+max_fps = 60                # 0 renders as fast as possible
 font_size = 16
-pygame.init()
-pygame.mixer.init()
+
+# Default reward factors from 'Tetris AI – The (Near) Perfect Bot'
+# for aggregated height, cleared lines, holes and bumpiness
+reward_weights = (-0.510066, 0.760666, -0.35663, -0.184483)
 
 colors = [
     (0, 0, 0),
@@ -85,7 +89,7 @@ def check_collision(board, shape, offset):
 
 def remove_row(board, row):
     del board[row]
-    return [[0 for i in range(cols)]] + board
+    return [[0 for i in range(len(board[0]))]] + board
 
 
 def join_matrixes(mat1, mat2, mat2_off):
@@ -96,21 +100,313 @@ def join_matrixes(mat1, mat2, mat2_off):
     return mat1
 
 
-def create_board():
+def create_board(cols=cols, rows=rows):
     board = [[0 for x in range(cols)]
              for y in range(rows)]
     board += [[1 for x in range(cols)]]
     return board
 
 
+# ================================================================================================#
+#                                       Bitboard Engine                                          #
+# ================================================================================================#
+
+# The bitboard stores every row of the board as one int, bit x is set if column x is filled.
+# The floor row below the board is a full row, so its mask gives the width of the board
+def full_row(cols):
+    return (1 << cols) - 1
+
+
+def shape_key(shape):
+    return tuple(map(tuple, shape))
+
+
+def row_masks(shape, off_x):
+    return tuple(sum(1 << (off_x + x) for x, val in enumerate(row) if val)
+                 for row in shape)
+
+
+# The colors of the board are kept the same way, with four bits per cell holding its color
+def color_row(row, off_x=0):
+    return sum(val << 4 * (off_x + x) for x, val in enumerate(row))
+
+
+def color_rows_from_board(board):
+    return [color_row(row) for row in board]
+
+
+def create_color_rows(cols=cols, rows=rows):
+    return [0] * rows + [color_row([1] * cols)]
+
+
+def board_from_color_rows(color_rows, cols):
+    return [[row >> 4 * x & 15 for x in range(cols)] for row in color_rows]
+
+
+# Row masks of every rotation of every shape, for every column offset the shape fits in
+def build_shape_masks(cols=cols):
+    masks = {}
+    for shape in tetris_shapes:
+        for rotation in range(4):
+            masks[shape_key(shape)] = [row_masks(shape, off_x)
+                                       for off_x in range(cols - len(shape[0]) + 1)]
+            shape = rotate_clockwise(shape)
+    return masks
+
+
+def check_collision_bits(bitboard, masks, offset):
+    off_x, off_y = offset
+    # Outside of the board counts as a collision, just like the IndexError in check_collision
+    if off_x < 0:
+        return True
+    try:
+        for mask in masks[off_x]:
+            if bitboard[off_y] & mask:
+                return True
+            off_y += 1
+    except IndexError:
+        return True
+    return False
+
+
+def join_bits(bitboard, masks, offset):
+    off_x, off_y = offset
+    for cy, mask in enumerate(masks[off_x]):
+        bitboard[cy + off_y - 1] |= mask
+    return bitboard
+
+
+def create_bitboard(cols=cols, rows=rows):
+    return [0] * rows + [full_row(cols)]
+
+
+def bitboard_from_board(board):
+    return [sum(1 << x for x, val in enumerate(row) if val) for row in board]
+
+
+def remove_full_bit_rows(bitboard):
+    rows, full_row_mask = len(bitboard) - 1, bitboard[-1]
+    kept = [row for row in bitboard[:rows] if row != full_row_mask]
+    cleared_rows = rows - len(kept)
+    return [0] * cleared_rows + kept + [full_row_mask], cleared_rows
+
+
+def count_bits(n):
+    return bin(n).count('1')
+
+
+# int.bit_count is only there from Python 3.10 on
+if hasattr(int, 'bit_count'):
+    count_bits = int.bit_count
+
+
+# Holes, filled cells with an empty cell right below, in the rows first to last - 1
+def count_holes(bitboard, first, last):
+    holes = 0
+    for y in range(first, last):
+        holes += count_bits(bitboard[y] & ~bitboard[y + 1])
+    return holes
+
+
+def bitboard_heights(bitboard):
+    rows, full_row_mask = len(bitboard) - 1, bitboard[-1]
+    heights = [0] * full_row_mask.bit_length()
+    seen = 0
+    for y in range(rows):
+        # The highest filled cell of a column is the first one seen from the top
+        new = bitboard[y] & ~seen
+        while new:
+            lowest = new & -new
+            heights[lowest.bit_length() - 1] = rows - y
+            new ^= lowest
+        seen |= bitboard[y]
+        if seen == full_row_mask:
+            break
+    return heights
+
+
+# Aggregated height, bumpiness and holes of a bitboard, the same measures TetrisApp tracks
+def bitboard_features(bitboard):
+    heights = bitboard_heights(bitboard)
+    bumpiness = sum(abs(heights[x] - heights[x + 1]) for x in range(len(heights) - 1))
+    return sum(heights), bumpiness, count_holes(bitboard, 0, len(bitboard) - 1)
+
+
+# ================================================================================================#
+#                                        Piece Tables                                            #
+# ================================================================================================#
+
+# One rotation of a piece. shape is the matrix as nested tuples, cells the (x, y) offsets of its
+# filled cells, bottom and top the lowest and highest filled row of every column of the shape,
+# spawn_x the column the piece starts in, masks its bitboard row masks and color_masks its color
+# row masks, both for every column offset
+PieceRotation = collections.namedtuple('PieceRotation', ['shape', 'cells', 'width', 'height', 'bottom', 'top',
+                                                         'spawn_x', 'masks', 'color_masks'])
+
+
+# Every rotation of every piece on a board cols wide, piece_rotations[piece][rotation] with the
+# rotations in the order rotate_clockwise turns them. Built once per width
+@functools.lru_cache(maxsize=None)
+def build_piece_rotations(cols=cols):
+    shape_masks = build_shape_masks(cols)
+    table = []
+    for shape in tetris_shapes:
+        spawn_x = int(cols / 2 - len(shape[0]) / 2)
+        rotations = []
+        for rotation in range(4):
+            key = shape_key(shape)
+            cells = tuple((x, y) for y, row in enumerate(key) for x, val in enumerate(row) if val)
+            bottom = tuple(max(y for x, y in cells if x == column) for column in range(len(key[0])))
+            top = tuple(min(y for x, y in cells if x == column) for column in range(len(key[0])))
+            color_masks = [tuple(color_row(row, off_x) for row in key) for off_x in range(cols - len(key[0]) + 1)]
+            rotations.append(PieceRotation(key, cells, len(key[0]), len(key), bottom, top, spawn_x,
+                                           shape_masks[key], color_masks))
+            shape = rotate_clockwise(shape)
+        table.append(tuple(rotations))
+    return tuple(table)
+
+
+def check_board_size(cols, rows):
+    # Every piece has to fit in every rotation
+    if cols < 4 or rows < 4:
+        raise ValueError("The board must be at least 4x4, not %dx%d" % (cols, rows))
+    if cols > 16:
+        # Placements are recorded with the column in four bits
+        raise ValueError("The board can be at most 16 columns wide")
+
+
+# The tables of one board size, built once per size and shared by every game of that size
+BoardTables = collections.namedtuple('BoardTables', ['cols', 'rows', 'full_row_mask', 'piece_rotations'])
+
+
+@functools.lru_cache(maxsize=None)
+def board_tables(cols, rows):
+    check_board_size(cols, rows)
+    return BoardTables(cols, rows, full_row(cols), build_piece_rotations(cols))
+
+
+# The tables of the default board size
+full_row_mask = full_row(cols)
+piece_rotations = board_tables(cols, rows).piece_rotations
+shape_masks = {rotation.shape: rotation.masks for rotations in piece_rotations for rotation in rotations}
+
+
+def check_collision_cells(board, cells, offset):
+    # The same check as check_collision, on the filled cells only
+    off_x, off_y = offset
+    try:
+        for cx, cy in cells:
+            if board[cy + off_y][cx + off_x]:
+                return True
+    except IndexError:
+        return True
+    return False
+
+
+# ================================================================================================#
+#                                       Piece Generator                                          #
+# ================================================================================================#
+
+class PieceGenerator(object):
+    """Stone ids from a private random stream, either uniform or from a shuffled bag of all seven stones"""
+
+    def __init__(self, seed=None, bag=False):
+        self.bag = bag
+        self.rng = random.Random()
+        self.bag_stones = []
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        self.rng.seed(seed)
+        self.bag_stones = []
+
+    def next(self):
+        if not self.bag:
+            return self.rng.randrange(len(tetris_shapes))
+        if not self.bag_stones:
+            self.bag_stones = list(range(len(tetris_shapes)))
+            self.rng.shuffle(self.bag_stones)
+        return self.bag_stones.pop()
+
+    def sequence(self, n):
+        """Returns the next n stone ids as an array"""
+        return np.array([self.next() for _ in range(n)], dtype=np.int64)
+
+
+# Buffer shape, dtype and network input shape of every observation mode of TetrisApp.observe
+observation_dtypes = {
+    'position': np.float32,
+    'features': np.float32,
+    'board': np.uint8
+}
+
+
+def observation_shapes(cols, rows):
+    return {
+        'position': (2,),
+        'features': (cols + 5,),
+        'board': (2, rows, cols)
+    }
+
+
+def observation_input_shapes(cols, rows):
+    return {
+        'position': (2, 1),
+        'features': (1, cols + 5),
+        'board': (1, 2 * rows * cols)
+    }
+
+
 # ================================================================================================#
 #                                       Main Game Part                                           #
 # ================================================================================================#
 
 class TetrisApp(object):
-    def __init__(self):
-        pygame.init()
-        pygame.key.set_repeat()  # Delay in milliseconds (250, 25) -> No delay needed?
+    # A headless app never opens a window and only runs the game logic.
+    # Otherwise the game is rendered every render_every steps, 0 turns rendering off.
+    # The engine is either 'list' or 'bitboard', both play by the same rules, see test_engines.py.
+    # The bitboard engine plays on the bit rows and updates the column features from the rows of
+    # each seated stone, the list board and board plane are only built when they are read.
+    # The observation mode decides what observe() and play() return as state, see observe.
+    # Every episode gets its own seed drawn from seed, the stones of an episode only depend on
+    # that episode seed, and bag picks the 7-bag randomizer instead of uniform stones.
+    # The board is cols x rows cells and the reward the reward_weights sum of the board features,
+    # games of the same size share their piece tables
+    def __init__(self, headless=False, render_every=1, engine='list', obs_mode='position', seed=None, bag=False,
+                 cols=cols, rows=rows, reward_weights=reward_weights):
+        if engine not in ('list', 'bitboard'):
+            raise ValueError("Unknown engine: %s" % engine)
+        if obs_mode not in observation_dtypes:
+            raise ValueError("Unknown observation mode: %s" % obs_mode)
+        if len(reward_weights) != 4:
+            raise ValueError("There are four reward weights, for height, lines, holes and bumpiness")
+        self.engine = engine
+        self.bitboard = None
+        self.color_rows = None
+
+        self.cols = cols
+        self.rows = rows
+        self.reward_weights = tuple(reward_weights)
+        tables = board_tables(cols, rows)
+        self.full_row_mask = tables.full_row_mask
+        self.piece_rotations = tables.piece_rotations
+
+        # Observations are written into two preallocated buffers used in turns, so the state
+        # returned by one step stays valid while the next step is played
+        self.obs_mode = obs_mode
+        self.observations = [np.zeros(observation_shapes(cols, rows)[obs_mode], dtype=observation_dtypes[obs_mode])
+                             for _ in range(2)]
+        self.observation_views = [observation.reshape(observation_input_shapes(cols, rows)[obs_mode])
+                                  for observation in self.observations]
+        for view in self.observation_views:
+            view.flags.writeable = False
+        self.obs_index = 0
+        self.board_plane = np.zeros((rows, cols), dtype=np.uint8)
+        self.board_plane_view = self.board_plane.view()
+        self.board_plane_view.flags.writeable = False
+        # Shifts of the cells of a color row, to decode the board plane of the bitboard engine
+        self.color_shifts = np.arange(cols, dtype=np.uint64) * np.uint64(4)
+
         self.width = cell_size * (cols + 6)
         self.height = cell_size * rows
         self.r_lim = cell_size * cols
@@ -118,6 +414,37 @@ class TetrisApp(object):
         # Make the grid in the background, 8 and 3 is the color
         self.b_ground_grid = [[8 if x % 2 == y % 2 else 0 for x in range(cols)] for y in range(rows)]
 
+        # Pygame is only initialized once a renderer is attached
+        self.headless = headless
+        self.screen = None
+        self.default_font = None
+        self.render_every = 0
+        self.max_fps = max_fps
+        self.step_counter = 0
+        self.action_from_agent = 0
+        if not headless:
+            self.set_render_every(render_every)
+
+        self.seed_generator = random.Random(seed)
+        self.pieces = PieceGenerator(bag=bag)
+        self.recorder = None
+        self.init_game()
+
+        # The methods are looked up at every call, so methods patched on the class, like the timed
+        # wrappers of profiling.Profiler, apply to every instance
+        self.actions = {
+            0: lambda: self.move(-1),        # Left
+            1: lambda: self.move(+1),        # Right
+            2: lambda: self.rotate_stone(),  # Rotate
+            3: lambda: self.instant_drop(),  # Instant drop
+            4: lambda: self.drop()           # Doing nothing, only drops
+        }
+
+    def init_display(self):
+        pygame.init()
+        pygame.mixer.init()
+        pygame.key.set_repeat()  # Delay in milliseconds (250, 25) -> No delay needed?
+
         #  Change the font in the game
         self.default_font = pygame.font.Font(
             pygame.font.get_default_font(), font_size)
@@ -125,31 +452,59 @@ class TetrisApp(object):
         self.screen = pygame.display.set_mode((self.width, self.height))
         # We do not need mouse movement events, so we block them.
         pygame.event.set_blocked(pygame.MOUSEMOTION)
-
-        self.next_stone = tetris_shapes[rand(len(tetris_shapes))]
-        self.init_game()
-
-        self.actions = {
-            0: lambda: self.move(-1),  # Left
-            1: lambda: self.move(+1),  # Right
-            2: self.rotate_stone,      # Rotate
-            3: self.instant_drop,      # Instant drop
-            4: self.drop               # Doing nothing, only drops
-        }
+        self.clock = pygame.time.Clock()
+        self.build_render_cache()
+
+    # Attach the renderer to every n:th step, or detach it with n = 0
+    def set_render_every(self, n):
+        if n and self.screen is None:
+            self.init_display()
+        self.render_every = n
+
+    # Records every step of the current and later episodes, see episode_log.EpisodeRecorder.
+    # Attach it before the first step of an episode, so the episode can be replayed from its seed
+    def set_recorder(self, recorder):
+        self.recorder = recorder
+        if recorder is not None:
+            recorder.start(self.episode_seed, self.pieces.bag, self.cols, self.rows, self.reward_weights)
+
+    # The stone is the (id, rotation) of an entry of the piece table, stone and next_stone are the
+    # shapes of the table and are never changed
+    def set_stone(self, stone_id, rotation):
+        self.stone_id = stone_id
+        self.stone_rotation = rotation
+        self.stone_piece = self.piece_rotations[stone_id][rotation]
+        self.stone = self.stone_piece.shape
 
     def new_stone(self):
-        self.stone = self.next_stone[:]
-        self.next_stone = tetris_shapes[rand(len(tetris_shapes))]
-        self.stone_x = int(cols / 2 - len(self.stone[0]) / 2)
+        self.set_stone(self.next_stone_id, 0)
+        self.next_stone_id = self.pieces.next()
+        self.next_stone = self.piece_rotations[self.next_stone_id][0].shape
+        self.stone_x = self.stone_piece.spawn_x
         self.stone_y = 0
 
-        if check_collision(self.board,
-                           self.stone,
-                           (self.stone_x, self.stone_y)):
+        if self.piece_collides(self.stone_piece,
+                               (self.stone_x, self.stone_y)):
             self.gameover = True
 
-    def init_game(self):
-        self.board = create_board()
+    # An episode is replayed exactly by starting it with the same seed and playing the same actions
+    def init_game(self, seed=None):
+        if seed is None:
+            seed = self.seed_generator.getrandbits(32)
+        self.episode_seed = seed
+        self.pieces.seed(seed)
+        if self.recorder is not None:
+            self.recorder.start(seed, self.pieces.bag, self.cols, self.rows, self.reward_weights)
+        self.next_stone_id = self.pieces.next()
+        self.next_stone = self.piece_rotations[self.next_stone_id][0].shape
+
+        self.list_board = create_board(self.cols, self.rows)
+        self.board_plane[:] = 0
+        self.board_synced = True
+        self.plane_synced = True
+        if self.engine == 'bitboard':
+            self.bitboard = create_bitboard(self.cols, self.rows)
+            self.color_rows = create_color_rows(self.cols, self.rows)
         self.new_stone()
         self.level = 1
         self.score = 0
@@ -157,18 +512,16 @@ class TetrisApp(object):
         self.action_reward = 0
         self.stop_ai = False
         self.gameover = False
+        self.cleared_rows = 0
+        self.pieces_placed = 0
 
-        # Init variables for the function bumpiness
-        self.total_bumpiness = 0
-        self.prev_col = float('NaN')  # Not to start outside of board
-        self.col = 0
-        self.bump_counter = 0
-
-        # Init variables for the function aggregated height
+        # Per column heights and holes, updated when a stone is seated or rows are cleared.
+        # The bitboard engine counts the holes of the rows, not of the columns
+        self.heights = [0] * self.cols
+        self.holes = [0] * self.cols if self.bitboard is None else None
         self.aggregated_height = 0
-        self.height_prev_col = float('NaN')  # Not to start outside of board
-        self.height_col = 0
-        self.height_counter = 0
+        self.total_bumpiness = 0
+        self.total_holes = 0
 
     def display_msg(self, msg, top_left):
         x, y = top_left
@@ -178,6 +531,8 @@ class TetrisApp(object):
             y += 30
 
     def center_msg(self, msg):
+        # The message is drawn over the cached frame, so the next frame is drawn in full
+        self.drawn_rows = None
         for i, line in enumerate(msg.splitlines()):
             msg_image = self.default_font.render(line, False,
                                                  (0, 0, 255), (0, 0, 0))
@@ -212,45 +567,157 @@ class TetrisApp(object):
             new_x = self.stone_x + delta_x
             if new_x < 0:
                 new_x = 0
-            if new_x > cols - len(self.stone[0]):
-                new_x = cols - len(self.stone[0])
-            if not check_collision(self.board,
-                                   self.stone,
-                                   (new_x, self.stone_y)):
+            if new_x > self.cols - self.stone_piece.width:
+                new_x = self.cols - self.stone_piece.width
+            if not self.piece_collides(self.stone_piece,
+                                       (new_x, self.stone_y)):
                 self.stone_x = new_x
 
+    # Collision check of a piece rotation with the engine of the game
+    def piece_collides(self, piece, offset):
+        if self.bitboard is None:
+            return check_collision_cells(self.list_board, piece.cells, offset)
+        return check_collision_bits(self.bitboard, piece.masks, offset)
+
+    # The list board with the color of every cell. The bitboard engine builds it and the board plane
+    # from its color rows only when they are read, for rendering, board observations or a search
+    @property
+    def board(self):
+        if not self.board_synced:
+            self.sync_board()
+        return self.list_board
+
+    @board.setter
+    def board(self, board):
+        self.list_board = board
+        self.board_plane[:] = board[:self.rows]
+        if self.bitboard is not None:
+            self.bitboard = bitboard_from_board(board)
+            self.color_rows = color_rows_from_board(board)
+        self.board_synced = True
+        self.plane_synced = True
+
+    def sync_board(self):
+        self.list_board = board_from_color_rows(self.color_rows, self.cols)
+        self.board_synced = True
+
+    def sync_plane(self):
+        color_rows = np.array(self.color_rows[:self.rows], dtype=np.uint64)
+        self.board_plane[:] = color_rows[:, None] >> self.color_shifts & np.uint64(15)
+        self.plane_synced = True
+
+    # Joins the stone with the board and updates the column features
+    def join_stone(self):
+        # Like join_matrixes, the stone is joined one row above its offset
+        piece = self.stone_piece
+        off_y = self.stone_y - 1
+        if self.bitboard is None:
+            color = self.stone_id + 1
+            for cx, cy in piece.cells:
+                self.list_board[cy + off_y][cx + self.stone_x] = color
+                self.board_plane[cy + off_y, cx + self.stone_x] = color
+            self.update_columns(range(self.stone_x, self.stone_x + piece.width))
+            return
+
+        # Only the holes in the rows of the stone and the row above it can change
+        first, last = max(off_y - 1, 0), off_y + piece.height
+        holes = count_holes(self.bitboard, first, last)
+        join_bits(self.bitboard, piece.masks, (self.stone_x, self.stone_y))
+        join_bits(self.color_rows, piece.color_masks, (self.stone_x, self.stone_y))
+        self.total_holes += count_holes(self.bitboard, first, last) - holes
+        self.raise_columns(piece, self.stone_x, off_y)
+        self.board_synced = False
+        self.plane_synced = False
+
+    # Removes all full rows and returns the number of cleared rows
+    def remove_full_rows(self):
+        cleared_rows = 0
+        if self.bitboard is None:
+            while True:
+                for i, row in enumerate(self.list_board[:-1]):
+                    if 0 not in row:
+                        self.list_board = remove_row(self.list_board, i)
+                        cleared_rows += 1
+                        break
+                else:
+                    break
+        else:
+            # Only the rows of the stone just joined can be full. Scanning from the top, the rows
+            # above a removed row are already checked
+            off_y = self.stone_y - 1
+            for i in range(off_y, off_y + self.stone_piece.height):
+                if self.bitboard[i] == self.full_row_mask:
+                    del self.bitboard[i]
+                    self.bitboard.insert(0, 0)
+                    del self.color_rows[i]
+                    self.color_rows.insert(0, 0)
+                    cleared_rows += 1
+        return cleared_rows
+
     def get_state(self):
         return self.stone_x, self.stone_y
 
+    # The falling stone as plain ints, hashable and cheap to store
+    def get_stone(self):
+        return self.stone_id, self.stone_rotation, self.stone_x, self.stone_y
+
+    def observe(self):
+        """Returns the observation in the shape and dtype DQNAgent takes as state. It is a read-only view
+        of a preallocated buffer that stays valid until the step after the next one.
+        position: the (x, y) of the stone as a (2, 1) float32 array, one row per network input
+        features: (1, cols + 5) float32 array of the column heights, holes, bumpiness, cleared lines,
+                  and the ids of the current and next stone
+        board:    (1, 2 * rows * cols) uint8 array of the board followed by a mask of the stone"""
+        self.obs_index = 1 - self.obs_index
+        observation = self.observations[self.obs_index]
+
+        if self.obs_mode == 'position':
+            observation[0] = self.stone_x
+            observation[1] = self.stone_y
+        elif self.obs_mode == 'features':
+            observation[:self.cols] = self.heights
+            observation[self.cols:] = (self.total_holes, self.total_bumpiness, self.lines,
+                                       self.stone_id, self.next_stone_id)
+        else:
+            if not self.plane_synced:
+                self.sync_plane()
+            observation[0] = self.board_plane
+            observation[1] = 0
+            for cx, cy in self.stone_piece.cells:
+                observation[1, cy + self.stone_y, cx + self.stone_x] = 1
+
+        return self.observation_views[self.obs_index]
+
+    # Read-only (rows, cols) view of the board, without the floor row
+    def get_board_view(self):
+        if not self.plane_synced:
+            self.sync_plane()
+        return self.board_plane_view
+
     def quit(self):
-        self.center_msg("Exiting...")
+        if self.stop_ai and self.screen is not None:
+            self.center_msg("Exiting...")
         return self.stop_ai
 
     def drop(self):
         if not self.gameover:
             self.stone_y += 1
-            if check_collision(self.board,
-                               self.stone,
-                               (self.stone_x, self.stone_y)):
-                self.board = join_matrixes(
-                    self.board,
-                    self.stone,
-                    (self.stone_x, self.stone_y))
-                self.new_stone()
-                self.bumpiness()  # Calculate bumpiness when a stone is seated
-                self.total_height()
-                self.number_of_holes()
-                # self.number_of_holes()  # Calculate number of holes when a stone is seated
-                cleared_rows = 0
-                while True:
-                    for i, row in enumerate(self.board[:-1]):
-                        if 0 not in row:
-                            self.board = remove_row(self.board, i)
-                            cleared_rows += 1
-                            break
+            if self.piece_collides(self.stone_piece,
+                                   (self.stone_x, self.stone_y)):
+                self.join_stone()
+                self.pieces_placed += 1
+                cleared_rows = self.remove_full_rows()
+                if cleared_rows:
+                    self.rescan_columns()
+                    if self.bitboard is None:
+                        self.board_plane[:] = self.list_board[:self.rows]
                     else:
-                        break
+                        self.board_synced = False
+                        self.plane_synced = False
+                self.cleared_rows = cleared_rows
                 self.add_cl_lines(cleared_rows)
+                # The next stone is spawned on the cleared board, so it never overlaps shifted rows
+                self.new_stone()
                 return True
         return False
 
@@ -261,84 +728,93 @@ class TetrisApp(object):
 
     def rotate_stone(self):
         if not self.gameover:
-            new_stone = rotate_clockwise(self.stone)
-            if not check_collision(self.board,
-                                   new_stone,
-                                   (self.stone_x, self.stone_y)):
-                self.stone = new_stone
+            rotation = (self.stone_rotation + 1) % 4
+            if not self.piece_collides(self.piece_rotations[self.stone_id][rotation],
+                                       (self.stone_x, self.stone_y)):
+                self.set_stone(self.stone_id, rotation)
 
-    # Sum and maximum height of the board
+    # Column features are tracked incrementally, these are plain reads of the totals
+    # Sum of the column heights of the board
     def total_height(self):
-        self.aggregated_height = 0
-        for c in zip(*self.board):
-
-            for val in c:
-                if val == 0:
-                    self.height_counter += 1
-                else:
-                    break
-            self.height_col = abs(self.height_counter - rows)
-            if not np.isnan(self.height_prev_col):
-                self.aggregated_height = self.aggregated_height + self.height_col
-
-            self.height_prev_col = self.height_col
-            self.height_col = 0
-            self.height_counter = 0
-
         return self.aggregated_height
 
-    # Calculate the bumpiness in the board
+    # Sum of the height differences between neighbouring columns
     def bumpiness(self):
-        self.total_bumpiness = 0
-        for c in zip(*self.board):
-
-            for val in c:
-                if val == 0:
-                    self.bump_counter += 1
-                else:
-                    break
-            self.col = abs(self.bump_counter - rows)
-            if not np.isnan(self.prev_col):
-                self.total_bumpiness = self.total_bumpiness + abs(self.prev_col - self.col)
-
-            self.prev_col = self.col
-            self.col = 0
-            self.bump_counter = 0
-
         return self.total_bumpiness
 
+    # Number of filled cells with an empty cell right below, summed over the columns
     def number_of_holes(self):
-        total_holes = 0
-        holes_counter = 0
-        prev_cell = float('NaN')
-
-        for col in zip(*self.board):
-            for val in col:
-                if not np.isnan(prev_cell):  # If prev cell is not a number (For every new column)
-                    if val == 0 and prev_cell != 0:
-                        holes_counter += 1
-                prev_cell = val
-
-            # Do this for every column
-            total_holes += holes_counter
-            holes_counter = 0
-            prev_cell = float('NaN')
-
-        return total_holes
-
-    def start_game(self, terminated):
+        return self.total_holes
+
+    # The column scans of the list engine
+    def column_height(self, x):
+        for y in range(self.rows):
+            if self.list_board[y][x]:
+                return self.rows - y
+        return 0
+
+    def column_holes(self, x):
+        holes = 0
+        for y in range(self.rows):
+            if self.list_board[y][x] and not self.list_board[y + 1][x]:
+                holes += 1
+        return holes
+
+    # Rescans only the given columns after a stone is joined with the board
+    def update_columns(self, columns):
+        # Only the bumpiness between the given columns and their neighbours can change
+        pairs = range(max(columns[0] - 1, 0), min(columns[-1] + 1, self.cols - 1))
+        for x in pairs:
+            self.total_bumpiness -= abs(self.heights[x] - self.heights[x + 1])
+
+        for x in columns:
+            height = self.column_height(x)
+            holes = self.column_holes(x)
+            self.aggregated_height += height - self.heights[x]
+            self.total_holes += holes - self.holes[x]
+            self.heights[x] = height
+            self.holes[x] = holes
+
+        for x in pairs:
+            self.total_bumpiness += abs(self.heights[x] - self.heights[x + 1])
+
+    # The bitboard engine raises the columns under a joined stone to its top cells, without a scan
+    def raise_columns(self, piece, off_x, off_y):
+        heights = self.heights
+        pairs = range(max(off_x - 1, 0), min(off_x + piece.width, self.cols - 1))
+        for x in pairs:
+            self.total_bumpiness -= abs(heights[x] - heights[x + 1])
+
+        for cx, top in enumerate(piece.top):
+            height = self.rows - off_y - top
+            if height > heights[off_x + cx]:
+                self.aggregated_height += height - heights[off_x + cx]
+                heights[off_x + cx] = height
+
+        for x in pairs:
+            self.total_bumpiness += abs(heights[x] - heights[x + 1])
+
+    # Rescans every column, only needed when rows are cleared
+    def rescan_columns(self):
+        if self.bitboard is None:
+            self.heights = [self.column_height(x) for x in range(self.cols)]
+            self.holes = [self.column_holes(x) for x in range(self.cols)]
+            self.total_holes = sum(self.holes)
+        else:
+            self.heights = bitboard_heights(self.bitboard)
+            self.total_holes = count_holes(self.bitboard, 0, self.rows)
+        self.aggregated_height = sum(self.heights)
+        self.total_bumpiness = sum(abs(self.heights[x] - self.heights[x + 1]) for x in range(self.cols - 1))
+
+    def start_game(self, terminated, seed=None):
         # print(terminated)
         self.gameover = terminated
 
         if not self.gameover:
-            self.init_game()
+            self.init_game(seed)
 
     def get_reward(self):
-        # Factors from 'Tetris AI – The (Near) Perfect Bot'
-        a = -0.510066
-        b = 0.760666
-        c = -0.35663
-        d = -0.184483
+        a, b, c, d = self.reward_weights
 
         self.action_reward = a * self.total_height() + b * self.lines + c * self.number_of_holes() + d * self.bumpiness()
 
@@ -347,11 +823,12 @@ class TetrisApp(object):
     def get_number_of_lines(self):
         return self.lines
 
+    def get_number_of_pieces(self):
+        return self.pieces_placed
+
     def reset_reward(self):
         self.score = 0
         self.action_reward = 0
-        self.total_bumpiness = 0
-        self.aggregated_height = 0
 
     def get_terminated(self):
         return self.gameover
@@ -362,43 +839,191 @@ class TetrisApp(object):
             if x == self.action_from_agent:
                 self.actions[self.action_from_agent]()
 
-        self.render_game()
+        self.step_counter += 1
+        if self.render_every and self.step_counter % self.render_every == 0:
+            self.render_game()
         self.drop()
 
         # Declared new variables to make the return-line a reasonable length
-        state = self.get_state()
+        state = self.observe()
         reward = self.get_reward()
         terminated = self.get_terminated()
         bumpiness = self.bumpiness()
         height = self.total_height()
         holes = self.number_of_holes()
 
-        return state, reward, terminated, bumpiness, height, holes
+        if self.recorder is not None:
+            self.recorder.record(action, reward, bumpiness, height, holes)
 
-    def render_game(self):
-        dont_burn_my_cpu = pygame.time.Clock()
+        return state, reward, terminated, bumpiness, height, holes
 
-        # Fills the screen background with black (RGB)
-        self.screen.fill((0, 0, 0))
+    # Features of the board after the last seated stone, in the same order as the placement features
+    def get_board_features(self):
+        return self.cleared_rows, self.number_of_holes(), self.bumpiness(), self.total_height()
+
+    def get_placements(self):
+        """Returns every reachable final position of the current stone as (rotation, x, features),
+        where features are the cleared lines, holes, bumpiness and height of the resulting board"""
+        placements = []
+        if self.gameover:
+            return placements
+
+        if self.bitboard is not None:
+            bitboard = self.bitboard
+        else:
+            bitboard = bitboard_from_board(self.list_board)
+
+        seen_shapes = set()
+        for rotation in range(4):
+            piece = self.piece_rotations[self.stone_id][(self.stone_rotation + rotation) % 4]
+            masks = piece.masks
+            # A rotation is only reachable if every turn before it fits at the spawn position
+            if rotation and check_collision_bits(bitboard, masks, (self.stone_x, self.stone_y)):
+                break
+            if piece.shape in seen_shapes:
+                continue
+            seen_shapes.add(piece.shape)
+
+            # Move sideways at the spawn row until something is in the way
+            for direction in (-1, 1):
+                off_x = self.stone_x if direction < 0 else self.stone_x + 1
+                while not check_collision_bits(bitboard, masks, (off_x, self.stone_y)):
+                    off_y = self.stone_y
+                    while not check_collision_bits(bitboard, masks, (off_x, off_y + 1)):
+                        off_y += 1
+                    result = join_bits(list(bitboard), masks, (off_x, off_y + 1))
+                    result, cleared_rows = remove_full_bit_rows(result)
+                    height, bumpiness, holes = bitboard_features(result)
+                    placements.append((rotation, off_x, (cleared_rows, holes, bumpiness, height)))
+                    off_x += direction
+
+        return placements
+
+    def play_placement(self, rotation, x):
+        """Rotates the current stone, moves it to column x and drops it, returns the same tuple as play"""
+        self.action_from_agent = 3
+        for _ in range(rotation):
+            self.rotate_stone()
+        self.move(x - self.stone_x)
+
+        self.step_counter += 1
+        if self.render_every and self.step_counter % self.render_every == 0:
+            self.render_game()
+        self.instant_drop()
+
+        state = self.get_board_features()
+        reward = self.get_reward()
+        terminated = self.get_terminated()
 
-        pygame.draw.line(self.screen,
+        # A placement is recorded as one byte, the rotation in the high and the column in the low bits
+        if self.recorder is not None:
+            self.recorder.record(rotation << 4 | x, reward, self.bumpiness(), self.total_height(),
+                                 self.number_of_holes())
+
+        return state, reward, terminated, self.bumpiness(), self.total_height(), self.number_of_holes()
+
+    # ============================================================================================#
+    #                                          Rendering                                          #
+    # ============================================================================================#
+
+    # Everything that looks the same in every frame is drawn once: a sprite per cell color, the
+    # background with the grid, the divider and the labels, and the text of the HUD values seen so far
+    def build_render_cache(self):
+        self.cell_sprites = [None]
+        for color in colors[1:]:
+            sprite = pygame.Surface((cell_size, cell_size))
+            sprite.fill((0, 0, 0))
+            pygame.draw.rect(sprite, color, pygame.Rect(0, 0, cell_size_inner, cell_size_inner), 0)
+            pygame.draw.rect(sprite, color, pygame.Rect(0, 0, cell_size, cell_size), 2)
+            # Black is see-through, so the background shows between the inner and the outer square
+            sprite.set_colorkey((0, 0, 0))
+            self.cell_sprites.append(sprite.convert())
+
+        self.background = pygame.Surface((self.width, self.height)).convert()
+        self.background.fill((0, 0, 0))
+        pygame.draw.line(self.background,
                          (255, 255, 255),
                          (self.r_lim + 1, 0),
                          (self.r_lim + 1, self.height - 1))
-        self.display_msg("Next:", (
-            self.r_lim + cell_size,
-            2))
-        self.display_msg("Score: %d\nLines: %d\nAction reward: %d\nAction: %d\nBumpiness: %d\nTotal height: "
-                         "%d\nHoles: %d" % (self.score, self.lines, self.get_reward(), self.action_from_agent,
-                                            self.bumpiness(), self.total_height(), self.number_of_holes()),
-                         (self.r_lim + cell_size, cell_size * 5))
-
-        self.draw_matrix(self.b_ground_grid, (0, 0))
-        self.draw_matrix(self.board, (0, 0))
-        self.draw_matrix(self.stone,
-                         (self.stone_x, self.stone_y))
-        self.draw_matrix(self.next_stone,
-                         (cols + 1, 2))
+        self.background.blit(self.default_font.render("Next:", False, (255, 255, 255), (0, 0, 0)),
+                             (self.r_lim + cell_size, 2))
+        for y, row in enumerate(self.b_ground_grid):
+            for x, val in enumerate(row):
+                if val:
+                    self.background.blit(self.cell_sprites[val], (x * cell_size, y * cell_size))
+
+        self.text_cache = {}
+        # What is on the screen now, None until the first full frame
+        self.drawn_rows = None
+        self.drawn_next_stone = None
+        self.drawn_hud = None
+
+    def render_text(self, text):
+        image = self.text_cache.get(text)
+        if image is None:
+            if len(self.text_cache) > 4096:
+                self.text_cache.clear()
+            image = self.default_font.render(text, False, (255, 255, 255), (0, 0, 0))
+            self.text_cache[text] = image
+        return image
+
+    def draw_cells(self, cells, offset):
+        # Draws the rows of cells at offset over the background and returns the area drawn
+        off_x, off_y = offset
+        area = pygame.Rect(off_x * cell_size, off_y * cell_size, len(cells[0]) * cell_size, len(cells) * cell_size)
+        self.screen.blit(self.background, area, area)
+        for y, row in enumerate(cells):
+            for x, val in enumerate(row):
+                if val:
+                    self.screen.blit(self.cell_sprites[val], ((off_x + x) * cell_size, (off_y + y) * cell_size))
+        return area
+
+    def frame_rows(self):
+        # The board rows with the falling stone drawn into them
+        frame = self.board[:self.rows]
+        stone_rows = {}
+        for cx, cy in self.stone_piece.cells:
+            y = self.stone_y + cy
+            if 0 <= y < self.rows:
+                if y not in stone_rows:
+                    stone_rows[y] = list(frame[y])
+                stone_rows[y][self.stone_x + cx] = self.stone[cy][cx]
+        return [tuple(stone_rows[y]) if y in stone_rows else tuple(frame[y]) for y in range(self.rows)]
+
+    def render_game(self):
+        """Draws the parts of the frame that changed since the last one and updates only those areas
+        of the window. The first frame, and the first after a message, is drawn in full"""
+        full = self.drawn_rows is None
+        if full:
+            self.screen.blit(self.background, (0, 0))
+            self.drawn_rows = [None] * self.rows
+            self.drawn_next_stone = None
+            self.drawn_hud = [None] * 7
+        dirty = []
+
+        for y, row in enumerate(self.frame_rows()):
+            if row != self.drawn_rows[y]:
+                dirty.append(self.draw_cells([row], (0, y)))
+                self.drawn_rows[y] = row
+
+        if self.next_stone_id != self.drawn_next_stone:
+            dirty.append(self.draw_cells([[0] * 4] * 2, (self.cols + 1, 2)))
+            self.draw_cells(self.next_stone, (self.cols + 1, 2))
+            self.drawn_next_stone = self.next_stone_id
+
+        # Only the lines of the HUD whose value changed are drawn again
+        a, b, c, d = self.reward_weights
+        reward = a * self.aggregated_height + b * self.lines + c * self.total_holes + d * self.total_bumpiness
+        hud = ("Score: %d" % self.score, "Lines: %d" % self.lines, "Action reward: %d" % reward,
+               "Action: %d" % self.action_from_agent, "Bumpiness: %d" % self.total_bumpiness,
+               "Total height: %d" % self.aggregated_height, "Holes: %d" % self.total_holes)
+        for i, text in enumerate(hud):
+            if text != self.drawn_hud[i]:
+                area = pygame.Rect(self.r_lim + cell_size, cell_size * 5 + i * 30, self.width - self.r_lim - cell_size, 30)
+                self.screen.blit(self.background, area, area)
+                self.screen.blit(self.render_text(text), area.topleft)
+                dirty.append(area)
+                self.drawn_hud[i] = text
 
         # Need to just handle event in pygame to be able to move window
         for event in pygame.event.get():
@@ -407,5 +1032,8 @@ class TetrisApp(object):
                 self.stop_ai = True
                 self.quit()
 
-        pygame.display.update()
-        dont_burn_my_cpu.tick(max_fps)
+        if full:
+            pygame.display.update()
+        elif dirty:
+            pygame.display.update(dirty)
+        self.clock.tick(self.max_fps)
@@ -0,0 +1,204 @@
+# =============================================================================#
+# Name        : trainer.py                                                     #
+# Description : DQN training loop with configurable update schedules           #
+# ---------------------------------------------------------------------------- #
+# The trainer decides when the agent learns, independent of the env steps:     #
+# every train_every steps it owes gradient_steps updates, once the replay      #
+# holds warmup transitions. With threaded=True a learner thread pays off those #
+# updates while the environment keeps stepping.                                #
+# =============================================================================#
+
+import threading
+import time
+
+import numpy as np
+
+
+class LinearSchedule(object):
+    """Goes linearly from start to end over steps, then stays at end. Picklable, so it also works as
+    an actor epsilon in actor_learner"""
+
+    def __init__(self, start, end, steps):
+        self.start = start
+        self.end = end
+        self.steps = steps
+
+    def __call__(self, step):
+        if step >= self.steps:
+            return self.end
+        return self.start + (self.end - self.start) * step / self.steps
+
+
+class Trainer(object):
+    """Plays episodes of environment with agent and trains it on a schedule.
+
+    target_update_every is in env steps, None aligns the target network at the end of every episode.
+    With tau < 1 the target network moves that fraction towards the Q-network at each update.
+    epsilon is a constant or a schedule taking the env step, None leaves agent.epsilon alone.
+    max_lag bounds how many updates the learner thread may owe before the environment waits for it,
+    None lets the environment run ahead freely"""
+
+    def __init__(self, environment, agent, batch_size=32, train_every=1, gradient_steps=1, warmup=None,
+                 target_update_every=None, tau=1.0, epsilon=None, threaded=False, max_lag=None):
+        self.environment = environment
+        self.agent = agent
+        self.batch_size = batch_size
+        self.train_every = train_every
+        self.gradient_steps = gradient_steps
+        self.warmup = agent.start_size if warmup is None else warmup
+        self.target_update_every = target_update_every
+        self.tau = tau
+        self.epsilon = epsilon
+        self.threaded = threaded
+        self.max_lag = max_lag
+
+        self.env_steps = 0
+        self.updates = 0
+        self.owed_updates = 0
+
+        # replay_lock guards the replay buffer, train_lock the networks while the learner thread trains
+        self.replay_lock = threading.Lock()
+        self.train_lock = threading.Lock()
+        self.work = threading.Condition()
+        self.stop_event = threading.Event()
+        self.learner = None
+        # An update that failed on the learner thread, raised again on the environment thread
+        self.error = None
+
+    # ============================================================================================#
+    #                                         Learning                                            #
+    # ============================================================================================#
+
+    def ready(self):
+        return len(self.agent.experience_replay) >= max(self.warmup, self.batch_size)
+
+    def update(self):
+        """One gradient step on a minibatch from the replay"""
+        with self.replay_lock:
+            batch, indices, weights = self.agent.experience_replay.sample_weighted(self.batch_size)
+        with self.train_lock:
+            td_errors = self.agent.train_on_batch(batch, None, weights)
+        with self.replay_lock:
+            self.agent.experience_replay.update_priorities(indices, td_errors)
+        self.updates += 1
+
+    def update_target(self):
+        with self.train_lock:
+            if self.tau >= 1.0:
+                self.agent.align_target_model()
+            else:
+                self.agent.soft_update_target(self.tau)
+
+    def run_learner(self):
+        while True:
+            with self.work:
+                while not self.owed_updates and not self.stop_event.is_set():
+                    self.work.wait()
+                if self.stop_event.is_set():
+                    return
+                self.owed_updates -= 1
+                self.work.notify_all()
+            try:
+                self.update()
+            except Exception as error:
+                # Stopping wakes an environment waiting on max_lag, which then raises the error
+                with self.work:
+                    self.error = error
+                    self.stop_event.set()
+                    self.work.notify_all()
+                return
+
+    def check_learner(self):
+        """Raises the error the learner thread stopped with, if any"""
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def start(self):
+        if self.threaded and self.learner is None:
+            self.stop_event.clear()
+            self.learner = threading.Thread(target=self.run_learner, daemon=True)
+            self.learner.start()
+
+    def stop(self):
+        """Stops the learner thread, updates still owed are dropped. Raises the error the learner
+        thread failed with"""
+        if self.learner is not None:
+            with self.work:
+                self.stop_event.set()
+                self.work.notify_all()
+            self.learner.join()
+            self.learner = None
+        self.check_learner()
+
+    def after_step(self):
+        self.env_steps += 1
+        if self.ready() and self.env_steps % self.train_every == 0:
+            if self.threaded:
+                with self.work:
+                    self.owed_updates += self.gradient_steps
+                    self.work.notify_all()
+                    while (self.max_lag is not None and self.owed_updates > self.max_lag
+                           and not self.stop_event.is_set()):
+                        self.work.wait()
+                self.check_learner()
+            else:
+                for _ in range(self.gradient_steps):
+                    self.update()
+
+        if self.target_update_every and self.env_steps % self.target_update_every == 0:
+            self.update_target()
+
+    # ============================================================================================#
+    #                                          Acting                                             #
+    # ============================================================================================#
+
+    def step(self, state):
+        if self.agent.action_mode == 'placement':
+            # All final positions of the stone are scored in one forward pass
+            placements = self.environment.get_placements()
+            rotation, x, features = placements[self.agent.act_placement([p[2] for p in placements])]
+            transition = self.environment.play_placement(rotation, x)
+            return 0, transition
+        action = self.agent.act(state)
+        return action, self.environment.play(action)
+
+    def observe(self):
+        if self.agent.action_mode == 'placement':
+            return np.reshape(self.environment.get_board_features(), [1, -1])
+        return self.environment.observe()
+
+    def run_episode(self, time_steps):
+        """Plays one episode of at most time_steps actions, returns (episode reward, seconds taken)"""
+        self.start()
+        environment = self.environment
+        environment.start_game(False)
+        state = self.observe()
+        episodes_reward = 0
+        start_timer = time.time()
+
+        for time_step in range(time_steps):
+            if self.epsilon is not None:
+                self.agent.epsilon = self.epsilon(self.env_steps) if callable(self.epsilon) else self.epsilon
+
+            environment.reset_reward()
+            action, (next_state, reward, terminated, bumpiness, total_height, total_holes) = self.step(state)
+            if self.agent.action_mode == 'placement':
+                next_state = np.reshape(next_state, [1, -1])
+            with self.replay_lock:
+                self.agent.store(state, action, reward, next_state, terminated, bumpiness, total_height,
+                                 total_holes)
+            state = next_state
+            episodes_reward += reward
+            self.after_step()
+
+            if terminated:
+                if self.target_update_every is None:
+                    self.update_target()
+                break
+
+            #  If we want to quit the ai
+            if environment.quit():
+                break
+
+        return episodes_reward, time.time() - start_timer
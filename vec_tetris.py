@@ -0,0 +1,222 @@
+# =============================================================================#
+# Name        : vec_tetris.py                                                  #
+# Description : Vectorized Tetris engine stepping many boards with NumPy       #
+# ---------------------------------------------------------------------------- #
+
+import functools
+import random
+
+import numpy as np
+
+from tetris_game import PieceGenerator, build_piece_rotations, check_board_size, reward_weights, cols, rows
+
+# Stones pre-generated per board at a time
+piece_chunk = 64
+
+
+# ================================================================================================#
+#                                       Piece Tables                                             #
+# ================================================================================================#
+
+# Every tetris shape has four cells, the tables hold the (x, y) offset of each
+# cell for every piece and rotation, taken from the piece table of a board cols wide.
+# They are built once per width and shared
+@functools.lru_cache(maxsize=None)
+def build_piece_tables(cols=cols):
+    piece_rotations = build_piece_rotations(cols)
+    cell_x = np.array([[[x for x, y in piece.cells] for piece in rotations] for rotations in piece_rotations])
+    cell_y = np.array([[[y for x, y in piece.cells] for piece in rotations] for rotations in piece_rotations])
+    width = np.array([[piece.width for piece in rotations] for rotations in piece_rotations])
+    spawn_x = np.array([rotations[0].spawn_x for rotations in piece_rotations])
+    return cell_x, cell_y, width, spawn_x
+
+
+piece_cell_x, piece_cell_y, piece_width, piece_spawn_x = build_piece_tables()
+
+
+# ================================================================================================#
+#                                       Vectorized Game                                          #
+# ================================================================================================#
+
+class VecTetris(object):
+    """Steps num_envs boards at once with the same rules as TetrisApp.play"""
+
+    # Every board has its own independent random stream derived from seed, and like in TetrisApp
+    # every episode of a board gets its own seed, bag picks the 7-bag randomizer.
+    # The boards are cols x rows cells with rewards weighted by reward_weights, like TetrisApp
+    def __init__(self, num_envs, seed=None, bag=False, cols=cols, rows=rows, reward_weights=reward_weights):
+        self.num_envs = num_envs
+        self.cols = cols
+        self.rows = rows
+        self.reward_weights = tuple(reward_weights)
+        check_board_size(cols, rows)
+        self.piece_cell_x, self.piece_cell_y, self.piece_width, self.piece_spawn_x = build_piece_tables(cols)
+        self.env_index = np.arange(num_envs)
+
+        board_seeds = np.random.SeedSequence(seed).generate_state(num_envs)
+        self.seed_generators = [random.Random(int(board_seed)) for board_seed in board_seeds]
+        self.pieces = [PieceGenerator(bag=bag) for _ in range(num_envs)]
+        self.episode_seeds = np.zeros(num_envs, dtype=np.int64)
+
+        # The upcoming stones of every board are pre-generated in chunks
+        self.piece_queue = np.zeros((num_envs, piece_chunk), dtype=np.int64)
+        self.piece_cursor = np.zeros(num_envs, dtype=np.int64)
+
+        # Boards have an extra filled row at the bottom, just like create_board
+        self.boards = np.zeros((num_envs, rows + 1, cols), dtype=np.uint8)
+        self.piece = np.zeros(num_envs, dtype=np.int64)
+        self.rotation = np.zeros(num_envs, dtype=np.int64)
+        self.stone_x = np.zeros(num_envs, dtype=np.int64)
+        self.stone_y = np.zeros(num_envs, dtype=np.int64)
+        self.next_piece = np.zeros(num_envs, dtype=np.int64)
+        self.lines = np.zeros(num_envs, dtype=np.int64)
+        self.gameover = np.zeros(num_envs, dtype=bool)
+
+        self.reset()
+
+    def reset(self, mask=None):
+        """Starts a new game on the boards in mask, or on every board"""
+        if mask is None:
+            mask = np.ones(self.num_envs, dtype=bool)
+
+        for i in self.env_index[mask]:
+            self.episode_seeds[i] = self.seed_generators[i].getrandbits(32)
+            self.pieces[i].seed(int(self.episode_seeds[i]))
+            self.piece_queue[i] = self.pieces[i].sequence(piece_chunk)
+        self.piece_cursor[mask] = 0
+
+        self.boards[mask] = 0
+        self.boards[mask, self.rows] = 1
+        self.lines[mask] = 0
+        self.gameover[mask] = False
+        self.next_piece[mask] = self.draw_pieces(self.env_index[mask])
+        self.new_stone(mask)
+
+    def draw_pieces(self, index):
+        pieces = self.piece_queue[index, self.piece_cursor[index]]
+        self.piece_cursor[index] += 1
+
+        # Refill the boards that used up their pre-generated stones
+        for i in index[self.piece_cursor[index] == piece_chunk]:
+            self.piece_queue[i] = self.pieces[i].sequence(piece_chunk)
+            self.piece_cursor[i] = 0
+        return pieces
+
+    def get_states(self):
+        """The (x, y) of every stone as a (num_envs, 2, 1) float32 array, one TetrisApp.observe position
+        observation per board"""
+        return np.stack((self.stone_x, self.stone_y), axis=1)[:, :, None].astype(np.float32)
+
+    def collides(self, index, piece, rotation, stone_x, stone_y):
+        """Checks the given stones against the boards in index, like check_collision"""
+        cx = stone_x[:, None] + self.piece_cell_x[piece, rotation]
+        cy = stone_y[:, None] + self.piece_cell_y[piece, rotation]
+        outside = (cx < 0) | (cx >= self.cols) | (cy > self.rows)
+        cells = self.boards[index[:, None], np.clip(cy, 0, self.rows), np.clip(cx, 0, self.cols - 1)]
+        return (outside | (cells != 0)).any(axis=1)
+
+    def new_stone(self, mask):
+        index = self.env_index[mask]
+        self.piece[index] = self.next_piece[index]
+        self.next_piece[index] = self.draw_pieces(index)
+        self.rotation[index] = 0
+        self.stone_x[index] = self.piece_spawn_x[self.piece[index]]
+        self.stone_y[index] = 0
+
+        self.gameover[index] |= self.collides(index, self.piece[index], self.rotation[index],
+                                              self.stone_x[index], self.stone_y[index])
+
+    def move(self, mask, delta_x):
+        index = self.env_index[mask & ~self.gameover]
+        piece = self.piece[index]
+        rotation = self.rotation[index]
+        new_x = np.clip(self.stone_x[index] + delta_x, 0, self.cols - self.piece_width[piece, rotation])
+        free = ~self.collides(index, piece, rotation, new_x, self.stone_y[index])
+        self.stone_x[index[free]] = new_x[free]
+
+    def rotate_stone(self, mask):
+        index = self.env_index[mask & ~self.gameover]
+        new_rotation = (self.rotation[index] + 1) % 4
+        free = ~self.collides(index, self.piece[index], new_rotation,
+                              self.stone_x[index], self.stone_y[index])
+        self.rotation[index[free]] = new_rotation[free]
+
+    def drop(self, mask):
+        """Drops the stones in mask one row and returns a mask of the stones that were seated"""
+        seated = np.zeros(self.num_envs, dtype=bool)
+        index = self.env_index[mask & ~self.gameover]
+        self.stone_y[index] += 1
+        hit = self.collides(index, self.piece[index], self.rotation[index],
+                            self.stone_x[index], self.stone_y[index])
+        index = index[hit]
+        if len(index) == 0:
+            return seated
+        seated[index] = True
+
+        # Join the stones with their boards one row above the collision
+        piece = self.piece[index]
+        cx = self.stone_x[index, None] + self.piece_cell_x[piece, self.rotation[index]]
+        cy = self.stone_y[index, None] + self.piece_cell_y[piece, self.rotation[index]] - 1
+        self.boards[index[:, None], cy, cx] = (piece + 1)[:, None]
+
+        self.lines[index] += self.remove_rows(index)
+        self.new_stone(seated)
+        return seated
+
+    def remove_rows(self, index):
+        """Removes all full rows of the boards in index and returns the number of cleared rows"""
+        boards = self.boards[index, :self.rows]
+        full = (boards != 0).all(axis=2)
+        cleared = full.sum(axis=1)
+        if not cleared.any():
+            return cleared
+
+        # A stable sort moves the full rows to the top and keeps the order of the others
+        order = np.argsort(~full, axis=1, kind='stable')
+        boards = np.take_along_axis(boards, order[:, :, None], axis=1)
+        boards[np.arange(self.rows)[None, :] < cleared[:, None]] = 0
+        self.boards[index, :self.rows] = boards
+        return cleared
+
+    def instant_drop(self, mask):
+        active = mask & ~self.gameover
+        while active.any():
+            active &= ~self.drop(active)
+
+    # Board features of every board, the same measures as in TetrisApp
+    def column_heights(self):
+        filled = self.boards[:, :self.rows] != 0
+        return np.where(filled.any(axis=1), self.rows - filled.argmax(axis=1), 0)
+
+    def total_height(self):
+        return self.column_heights().sum(axis=1)
+
+    def bumpiness(self):
+        return np.abs(np.diff(self.column_heights(), axis=1)).sum(axis=1)
+
+    def number_of_holes(self):
+        return ((self.boards[:, :-1] != 0) & (self.boards[:, 1:] == 0)).sum(axis=(1, 2))
+
+    def step(self, actions):
+        """Plays one action on every board, finished boards are reset before returning.
+        Returns the states, rewards, terminated flags, bumpiness, heights and holes"""
+        actions = np.asarray(actions)
+
+        self.move(actions == 0, -1)
+        self.move(actions == 1, +1)
+        self.rotate_stone(actions == 2)
+        self.instant_drop(actions == 3)
+        self.drop(actions == 4)
+        self.drop(np.ones(self.num_envs, dtype=bool))
+
+        a, b, c, d = self.reward_weights
+        bumpiness = self.bumpiness()
+        height = self.total_height()
+        holes = self.number_of_holes()
+        rewards = a * height + b * self.lines + c * holes + d * bumpiness
+        terminated = self.gameover.copy()
+
+        if terminated.any():
+            self.reset(terminated)
+
+        return self.get_states(), rewards, terminated, bumpiness, height, holes